@@ -13,20 +13,68 @@ import i24_logger.log_writer as log_writer
 import time
 import ijson
 import sys
+import numpy as np
 
 import utils.misc as misc
+from utils.fragment_store import FragmentStore, write_store
 
 verbs = ["medicates", "taunts", "sweettalks", "initiates", "harasses", "negotiates", "castigates", "disputes", "cajoles", "improvises",
          "surrenders", "escalates", "mumbles", "juxtaposes", "excites", "lionizes", "ruptures", "yawns","administers","flatters","foreshadows","buckles",
          "moans", "gasps", "yells", "praises", "impersonates", "giggles", "roars", "articulates", "capitalizes", "calibrates", "protests", "conforms"]
 max_trials = 10
 
+# time series fields that are converted to float when a document is read
+time_series_field = ["timestamp", "x_position", "y_position", "width", "length", "height", "velocity", "detection_confidence"]
+
 
 def thread_update_one(raw, _id, filter, fitx, fity):
     filter = [1 if i else 0 for i in filter]
     raw.update_one({"_id": _id}, {"$set": {"filter": filter,
                                             "fitx": list(fitx),
                                             "fity": list(fity)}}, upsert = True)
+
+
+def parse_fragment_numpy(doc):
+    '''
+    convert a raw document parsed with ijson(use_float=True) in place
+    time series become contiguous float64 arrays and stay as arrays downstream
+    '''
+    for key in time_series_field:
+        doc[key] = np.asarray(doc[key], dtype=np.float64)
+
+    doc["first_timestamp"] = float(doc["first_timestamp"])
+    doc["starting_x"] = float(doc["starting_x"])
+    doc["ending_x"] = float(doc["ending_x"])
+    doc["last_timestamp"] = float(doc["last_timestamp"])
+    doc["_id"] = doc["_id"]["$oid"]
+    doc["compute_node_id"] = 1
+
+    return misc.interpolate(doc, as_array=True)
+
+
+def parse_fragment(doc):
+    '''
+    convert a raw document parsed with ijson (decimals) in place to lists of floats
+    '''
+    # convert time series from decimal to float
+    doc["timestamp"] = list(map(float, doc["timestamp"]))
+    doc["x_position"] = list(map(float, doc["x_position"]))
+    doc["y_position"] = list(map(float, doc["y_position"]))
+    doc["width"] = list(map(float, doc["width"]))
+    doc["length"] = list(map(float, doc["length"]))
+    doc["height"] = list(map(float, doc["height"]))
+    doc["velocity"] = list(map(float, doc["velocity"]))
+    doc["detection_confidence"] = list(map(float, doc["detection_confidence"]))
+
+    doc["first_timestamp"] = float(doc["first_timestamp"])
+    doc["starting_x"] = float(doc["starting_x"])
+    doc["ending_x"] = float(doc["ending_x"])
+    doc["last_timestamp"] = float(doc["last_timestamp"])
+    doc["_id"] = doc["_id"]["$oid"]
+    doc["compute_node_id"] = 1
+    
+    return misc.interpolate(doc)
+
     
 def static_data_reader(default_param, db_param, raw_queue, query_filter, name=None):
     """
@@ -39,16 +87,41 @@ def static_data_reader(default_param, db_param, raw_queue, query_filter, name=No
         :param database_name: Name of database to connect to (do not confuse with collection name).
         :param collection_name: Name of database collection from which to query.
     :param raw_queue: Process-safe queue to which records that are "ready" are written.  multiprocessing.Queue
-    :param dir: "eb" or "wb"
+    :param query_filter: {"direction": 1 or -1} to only write fragments of that direction, None to write all
     :param: node: (str) compute_node_id for videonode
     :return:
+    default_param["reader_mode"]: "python" keeps the time series as lists of floats, 
+        "numpy" decodes them directly to float64 arrays (faster on large collections),
+        "store" memory-maps raw_collection.store made by convert_raw_collection
+    """
+    direction = query_filter["direction"] if query_filter else None
+    _read_to_queues(default_param, {direction: raw_queue}, name or "static_data_reader")
+    return
+
+
+def static_data_reader_split(default_param, db_param, eb_queue, wb_queue, name=None):
+    """
+    Read data from a static collection in a single pass and route each fragment to 
+    eb_queue or wb_queue by its direction field
+    :param default_param: same as static_data_reader
+    :param eb_queue: Process-safe queue for eastbound fragments (direction=1)
+    :param wb_queue: Process-safe queue for westbound fragments (direction=-1)
+    :return:
+    """
+    _read_to_queues(default_param, {1: eb_queue, -1: wb_queue}, name or "static_data_reader")
+    return
+
+
+def _read_to_queues(default_param, queues, name):
+    """
+    parse the raw collection once and write each fragment to queues[doc["direction"]]
+    queues: {direction: queue}. a None key receives fragments of any direction
+    fragments with no matching queue are skipped
     """
     # Signal handling: in live data read, SIGINT and SIGUSR1 are handled in the same way    
     
     # running_mode = os.environ["my_config_section"]
     logger = log_writer.logger
-    if name is None:
-        name = "static_data_reader"
     logger.set_name(name)
     setattr(logger, "_default_logger_extra",  {})
      
@@ -56,78 +129,115 @@ def static_data_reader(default_param, db_param, raw_queue, query_filter, name=No
     logger.info("{} starts reading from {}.json".format(name, default_param["raw_collection"]))
 
     min_queue_size = default_param["min_queue_size"]
+    reader_mode = default_param["reader_mode"]
     discard = 0 # counter for short (<3) tracks
+    skipped = 0 # counter for fragments in other directions
     cntr = 0
+    begin = time.time()
+    end = None
 
     
-    with open(default_param["raw_collection"]+'.json', 'rb') as f:
-        
-        try:
-            # keep filling the queues so that they are not low in stock
-            if raw_queue.qsize() <= min_queue_size :#or west_queue.qsize() <= min_queue_size:
-                
-                for doc in ijson.items(f, 'item'):
-                    cntr += 1
-
-                    if len(doc["timestamp"]) > 3: 
-                        # convert time series from decimal to float
-                        doc["timestamp"] = list(map(float, doc["timestamp"]))
-                        doc["x_position"] = list(map(float, doc["x_position"]))
-                        doc["y_position"] = list(map(float, doc["y_position"]))
-                        doc["width"] = list(map(float, doc["width"]))
-                        doc["length"] = list(map(float, doc["length"]))
-                        doc["height"] = list(map(float, doc["height"]))
-                        doc["velocity"] = list(map(float, doc["velocity"]))
-                        doc["detection_confidence"] = list(map(float, doc["detection_confidence"]))
-
-                        doc["first_timestamp"] = float(doc["first_timestamp"])
-                        doc["starting_x"] = float(doc["starting_x"])
-                        doc["ending_x"] = float(doc["ending_x"])
-                        doc["last_timestamp"] = float(doc["last_timestamp"])
-                        doc["_id"] = doc["_id"]["$oid"]
-                        doc["compute_node_id"] = 1
-                        
-                        doc = misc.interpolate(doc)
-                        # print(doc["_id"]["$oid"])
-                        # print(getattr(node, self.attr))
-                        raw_queue.put(doc)          
-                    else:
-                        print("****** discard ",doc["_id"])
-                        discard += 1
-
-
-            # if queue has sufficient number of items, then wait before the next iteration (throttle)
-            logger.info("** queue size is sufficient. wait")     
-            time.sleep(2)   
-         
+    try:
+        # keep filling the queues so that they are not low in stock
+        if all(q.qsize() <= min_queue_size for q in queues.values()):
             
-        except StopIteration:  # rri reaches the end
-            logger.warning("static_data_reader reaches the end of query range iteration. Exit")
+            for doc in iter_raw_docs(default_param):
+                cntr += 1
+                raw_queue = queues.get(doc["direction"], queues.get(None))
+
+                if raw_queue is None:
+                    skipped += 1
+
+                elif len(doc["timestamp"]) > 3:
+                    if reader_mode == "numpy":
+                        doc = parse_fragment_numpy(doc)
+                    elif reader_mode == "python":
+                        doc = parse_fragment(doc)
+                    # print(doc["_id"]["$oid"])
+                    # print(getattr(node, self.attr))
+                    raw_queue.put(doc)          
+                else:
+                    print("****** discard ",doc["_id"])
+                    discard += 1
+            end = time.time()
+
+
+        # if queue has sufficient number of items, then wait before the next iteration (throttle)
+        logger.info("** queue size is sufficient. wait")     
+        time.sleep(2)   
+     
         
-        except Exception as e:
-            logger.warning("Other exceptions occured. Exit. Exception:{}".format(str(e)))
+    except StopIteration:  # rri reaches the end
+        logger.warning("static_data_reader reaches the end of query range iteration. Exit")
+    
+    except Exception as e:
+        logger.warning("Other exceptions occured. Exit. Exception:{}".format(str(e)))
 
-        
     
     # logger.info("outside of while loop:qsize for raw_data_queue: east {}, west {}".format(east_queue.qsize(), west_queue.qsize()))
-    logger.debug("Discarded {} short tracks".format(discard))
+    elapsed = (end or time.time()) - begin
+    logger.info("{} read {} docs in {:.2f} sec ({:.0f} docs/sec, reader_mode={}, ijson backend={})".format(
+        name, cntr, elapsed, cntr/max(elapsed, 1e-9), default_param["reader_mode"], ijson.backend))
+    logger.debug("Discarded {} short tracks, skipped {} in other directions".format(discard, skipped))
     logger.info("Data reader closed. Exit {}.".format(name))
 
     return
+
+
+def iter_raw_docs(default_param):
+    '''
+    yield documents from the raw collection
+    "python" and "numpy" reader_mode stream the JSON file with ijson, the documents still need to be parsed
+    "store" reads the binary store made by convert_raw_collection, the documents are already parsed
+    '''
+    if default_param["reader_mode"] == "store":
+        yield from FragmentStore(default_param["raw_collection"]+".store")
+        return
+    
+    with open(default_param["raw_collection"]+'.json', 'rb') as f:
+        yield from ijson.items(f, 'item', use_float=default_param["reader_mode"] == "numpy")
+
+
+def convert_raw_collection(raw_collection, store_path=None):
+    '''
+    one-time conversion of raw_collection.json into a binary store (see utils/fragment_store.py)
+    fragments are parsed and interpolated the same way as the "numpy" reader_mode, short tracks are dropped
+    and the rest are sorted by last_timestamp, so that the "store" reader_mode can yield them directly
+    '''
+    if store_path is None:
+        store_path = raw_collection+".store"
+    
+    begin = time.time()
+    fragments = []
+    with open(raw_collection+'.json', 'rb') as f:
+        for doc in ijson.items(f, 'item', use_float=True):
+            if len(doc["timestamp"]) > 3:
+                fragments.append(parse_fragment_numpy(doc))
+    fragments.sort(key=lambda doc: doc["last_timestamp"])
+    
+    n = write_store(fragments, store_path)
+    print("Converted {} fragments from {}.json to {} in {:.2f} sec".format(n, raw_collection, store_path, time.time()-begin))
+    return store_path
     
 
     
 if __name__ == '__main__':
 
+    # python data_feed.py RAW_i [RAW_ii ...] converts each collection to a binary store (reader_mode "store")
+    if len(sys.argv) > 1:
+        for raw_collection in sys.argv[1:]:
+            convert_raw_collection(raw_collection)
+        sys.exit(0)
+
     import queue
     import json
     with open("parameters.json") as f:
         parameters = json.load(f)
 
     parameters["raw_collection"] = "iccv_raw1"
-    # east_queue = queue.Queue()
+    east_queue = queue.Queue()
     west_queue = queue.Queue()
-    static_data_reader(parameters, None, west_queue, None)
+    static_data_reader_split(parameters, None, east_queue, west_queue)
     
     
     # default_param, db_param, raw_queue, query_filter, 
\ No newline at end of file
@@ -12,7 +12,6 @@ if two fragments have time overlap:
     calculate the bhattar distance on the overlap
     if below a threshold, consider merging them
 """
-import networkx as nx
 import numpy as np
 import queue
 import pandas as pd
@@ -20,9 +19,9 @@ import time
 
 
 # from i24_database_api import DBClient
-from utils.misc import calc_fit_select, find_overlap_idx
-from utils.utils_stitcher_cost import bhattacharyya_distance
-from utils.misc import SortedDLL
+from utils.misc import calc_fit_select, find_overlap_idx, resample_uniform
+from utils.utils_stitcher_cost import bhattacharyya_distance_diag
+from utils.utils_merge import IntervalIndex, merge_bounds, NetworkxComponents, UnionFindComponents
 import warnings
 warnings.filterwarnings('error')
 
@@ -34,8 +33,8 @@ def merge_resample(traj, conf_threshold):
     traj: dict
     preprocess procedures
     1. filter based on conf
-    2. resample to df
-    return df
+    2. resample to 25hz
+    return traj
     TODO: DEAL WITH NAN after conf mask
     '''
     time_series_field = ["timestamp", "x_position", "y_position", "length", "width", "height"]
@@ -57,29 +56,12 @@ def merge_resample(traj, conf_threshold):
         for key in time_series_field:
             traj[key] = np.array(traj[key])
         
-    # resample to df
-    data = {key: traj[key] for key in time_series_field} 
-    df = pd.DataFrame(data, columns=data.keys()) 
-    index = pd.to_timedelta(df["timestamp"], unit='s')
-    df = df.set_index(index)
-    df = df.drop(columns = "timestamp")
-    
-    # resample to 100hz
+    # resample to 25hz
     # to avoid the bias introduced by "floor" resample..., first upsample to 10ms, and then downsample to 25hz,
     # this method does not "snap" the timestamps to floor
-    df=df.resample('10L').mean().interpolate(method="linear").resample('40L').asfreq()#.resample('0.04S')#.asfreq()#.interpolate(method="linear")
-    # df=df.groupby(df.index.floor('0.04S')).mean().resample('0.04S').asfreq()
-
-
-    df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
-    # df = df.interpolate(method='linear')
-    
-    # write to dict
-    # TODO: cast to np array instead
-    for key in df.columns:
-        traj[key] = df[key].values
-
-    traj["timestamp"] = df.index.values
+    data = {key: traj[key] for key in time_series_field if key != "timestamp"}
+    traj["timestamp"], resampled = resample_uniform(traj["timestamp"], data, dt=0.04)
+    traj.update(resampled)
     traj["first_timestamp"] = traj["timestamp"][0]
     traj["last_timestamp"] = traj["timestamp"][-1]
     traj["starting_x"] = traj["x_position"][0]
@@ -140,6 +122,55 @@ def merge_cost(track1, track2):
     return nll
 
 
+def merge_cost_batch(tracks, track2):
+    '''
+    merge_cost of every track in tracks (as track1) against track2, with the array math done once for all pairs
+    all tracks have to be resampled first (merge_resample)
+    the space overlap check of merge_cost is left to the caller (see IntervalIndex), 
+    pairs without time overlap get 1e5
+    the covariances are diagonal, so the bhattacharyya distance is written out in closed form
+    return: array of costs, one per track in tracks
+    '''
+    costs = np.full(len(tracks), 1e5)
+    t2 = track2["timestamp"]
+    idx = [j for j, track in enumerate(tracks) if track["timestamp"][-1] > t2[0] and t2[-1] > track["timestamp"][0]]
+    if not idx:
+        return costs
+    
+    # same overlapping slices as find_overlap_idx
+    s1, s2, K = [], [], []
+    for j in idx:
+        t1 = tracks[j]["timestamp"]
+        o1, o2 = max(t1[0], t2[0])-0.02, min(t1[-1], t2[-1])+0.02
+        a1, a2 = np.searchsorted(t1, o1), np.searchsorted(t2, o1)
+        length = min(np.searchsorted(t1, o2, side="right")-1-a1, np.searchsorted(t2, o2, side="right")-1-a2)
+        s1.append(a1)
+        s2.append(a2)
+        K.append(length+1)
+    K = np.array(K)
+    
+    # pack the overlapping parts of all pairs into flat arrays, one segment per pair
+    seg_start = np.concatenate([[0], np.cumsum(K)[:-1]])
+    pos2 = np.repeat(np.array(s2) - seg_start, K) + np.arange(K.sum()) # index into track2
+    packed = {key: np.concatenate([tracks[j][key][s:s+k] for j, s, k in zip(idx, s1, K)]) 
+              for key in ["x_position", "y_position", "length", "width"]}
+    
+    with np.errstate(invalid="ignore", divide="ignore"):
+        def seg_nanmean(arr):
+            valid = ~np.isnan(arr)
+            return np.add.reduceat(np.where(valid, arr, 0), seg_start) / np.add.reduceat(valid, seg_start)
+        
+        l1, w1 = seg_nanmean(packed["length"]), seg_nanmean(packed["width"])
+        l2, w2 = seg_nanmean(track2["length"][pos2]), seg_nanmean(track2["width"][pos2])
+        varx, vary = (l1+l2)/2, (w1+w2)/2
+        dx2 = np.add.reduceat((packed["x_position"] - track2["x_position"][pos2])**2, seg_start)
+        dy2 = np.add.reduceat((packed["y_position"] - track2["y_position"][pos2])**2, seg_start)
+        nll = 0.125 * (dx2/varx + dy2/vary)/(K+1) + 0.5 * np.log(varx*vary/np.sqrt(l1*w1*l2*w2))
+    
+    costs[idx] = nll
+    return costs
+
+
 def merge_cost_simple_distance(track1, track2):
     """
     track1 and 2 have to be resmplaed first
@@ -259,15 +290,12 @@ def overlap_cost(df1, df2):
     
     df3 = pd.merge(df1, df2, left_index=True, right_index=True) # inner join
     
-    bd = []
-    for i in range(len(df3)):
-        mu1 = np.array([df3["x_position_x"].values[i], df3["y_position_x"].values[i]]) # track1
-        mu2 = np.array([df3["x_position_y"].values[i], df3["y_position_y"].values[i]]) # track2
-        cov1 = np.diag([df3["length_x"].values[i], df3["width_x"].values[i]]) # x-variance scales with length, y variance scales with width
-        cov2 = np.diag([df3["length_y"].values[i], df3["width_y"].values[i]])
-
-        bd.append(bhattacharyya_distance(mu1, mu2, cov1, cov2))
-    
+    # one row per overlapping timestamp
+    mu1 = np.column_stack([df3["x_position_x"].values, df3["y_position_x"].values]) # track1
+    mu2 = np.column_stack([df3["x_position_y"].values, df3["y_position_y"].values]) # track2
+    var1 = np.column_stack([df3["length_x"].values, df3["width_x"].values]) # x-variance scales with length, y variance scales with width
+    var2 = np.column_stack([df3["length_y"].values, df3["width_y"].values])
+    bd = bhattacharyya_distance_diag(mu1, mu2, var1, var2, axis=1)
 
     nll = np.mean(bd)
     # except:
@@ -350,13 +378,18 @@ def merge_fragments(direction, fragment_queue, merged_queue, parameters, name=No
     CONF_THRESH = parameters["conf_threshold"]
     TIMEOUT = parameters["merger_timeout"]
     
-    G = nx.Graph() # merge graph, two nodes are connected if they can be merged
-    sdll = SortedDLL() # a data structure to ensure trajectories are ordered in last_timestamp
+    # merge graph, two nodes are connected if they can be merged
+    if parameters["merge_graph"] == "unionfind":
+        G = UnionFindComponents() 
+    else:
+        G = NetworkxComponents()
+    index = IntervalIndex() # time and x ranges of nodes in G, only overlapping pairs are scored
     
     HB = parameters["log_heartbeat"]
     begin = time.time() # to time for log messages
     start = begin
     cntr, ct1, ct2, ct3, input_obj, output_obj, low_conf_cnt = 0,0,0,0,0,0,0
+    pairs_total, pairs_scored = 0,0 # candidate pairs in G vs pairs that pass the interval index
     
     while True:
         try:
@@ -365,15 +398,12 @@ def merge_fragments(direction, fragment_queue, merged_queue, parameters, name=No
                 cntr += 1 # TODO: could over flow
             except queue.Empty:
                 print("merger timed out after {} sec.".format(TIMEOUT))
-                comps = nx.connected_components(G)
-                
-                for comp in comps:
-                    input_obj += len(comp)
+                for unmerged in G.pop_all():
+                    input_obj += len(unmerged)
                     output_obj += 1
-                    unmerged = [ G.nodes[v]["data"] for v in list(comp)]
                     merged = combine_merged_dict(unmerged)
                     merged_queue.put(merged) 
-                print("Final flushing {} raw fragments --> {} merged fragments".format(input_obj, output_obj),extra = None)
+                print("Final flushing {} raw fragments --> {} merged fragments".format(input_obj, output_obj))
                 break
             
            
@@ -389,59 +419,43 @@ def merge_fragments(direction, fragment_queue, merged_queue, parameters, name=No
             
             curr_time = resampled["last_timestamp"]
             curr_id = resampled["_id"]
-        
-            sdll.append({"id": curr_id, "tail_time": curr_time})
             
-            curr_nodes = list(G.nodes(data=True)) # current nodes in G
-            G.add_node(curr_id, data=resampled) 
+            bounds = merge_bounds(resampled)
+            curr_nodes = index.query(*bounds) # current nodes in G that overlap in time and space
+            pairs_total += G.number_of_nodes()
+            pairs_scored += len(curr_nodes)
+            G.add_node(curr_id, resampled, curr_time) 
+            index.insert(curr_id, *bounds)
             
                 
             t1 = time.time()
-            for node_id, node in curr_nodes:
-                # if they have time overlaps
-                dist = merge_cost(node["data"], resampled) # TODO: these two are not ordered in time,check time overlap within
-        
+            dists = merge_cost_batch([G.data(node_id) for node_id in curr_nodes], resampled)
+            for node_id, dist in zip(curr_nodes, dists):
                 if dist <= DIST_THRESH:
-                    G.add_edge(node_id, curr_id, weight = dist)
-                    sdll.update(key=curr_id, attr_val=curr_time)
-                    sdll.update(key=node_id, attr_val=curr_time)
+                    G.add_edge(node_id, curr_id, curr_time, weight = dist)
                     
             
             t2 = time.time()
             ct2 += t2-t1
             
             t1 = time.time()
-            to_remove = set()
-            # check if the first in lru is timed out
-            while True:
-                # node_id, latest_time = next(iter(lru.items()))
-                first = sdll.first_node()
-                first_id = first.id
-                first_tail = first.tail_time
-                if first_tail < curr_time - TIMEWIN:                
-                    comp = nx.node_connected_component(G, first_id)
-                    # if aa in comp or bb in comp:
-                    input_obj += len(comp)
-                    output_obj += 1
-                    unmerged = [G.nodes[v]["data"] for v in list(comp)]
-                    merged = combine_merged_dict(unmerged)
-                    merged_queue.put(merged) 
-                    to_remove = to_remove.union(comp)
-                    # [lru.pop(v) for v in comp]
-                    [sdll.delete(v) for v in comp]
-
-                else:
-                    break # no need to check lru further
-            
-            G.remove_nodes_from(to_remove)
+            # components whose first tail is timed out
+            for unmerged in G.pop_expired(curr_time - TIMEWIN):
+                input_obj += len(unmerged)
+                output_obj += 1
+                merged = combine_merged_dict(unmerged)
+                merged_queue.put(merged) 
+                for traj in unmerged:
+                    index.remove(traj["_id"])
             t2 = time.time()
             ct3 += t2-t1
             
             # heartbeat log
             now = time.time()
             if now - begin > HB:
-                print("Graph nodes : {}, Graph edges: {}, cache: {}".format(G.number_of_nodes(), G.number_of_edges(), sdll.count()))
+                print("Graph nodes : {}, Graph edges: {}".format(G.number_of_nodes(), G.number_of_edges()))
                 print("{} raw fragments --> {} merged fragments, skipped {} low_conf.".format(input_obj, output_obj, low_conf_cnt))
+                print("Scored {} of {} candidate pairs, pruned {:.1%} by interval index".format(pairs_scored, pairs_total, 1-pairs_scored/max(pairs_total, 1)))
                 begin = time.time()
         
         except (ConnectionResetError, BrokenPipeError, EOFError) as e:   
@@ -452,11 +466,9 @@ def merge_fragments(direction, fragment_queue, merged_queue, parameters, name=No
         except Exception as e: # other unknown exceptions are handled as error TODO UNTESTED CODE!
             print("Other error: {}, push all merged trajs to queue".format(e))
             
-            comps = nx.connected_components(G)
-            for comp in comps:
-                input_obj += len(comp)
+            for unmerged in G.pop_all():
+                input_obj += len(unmerged)
                 output_obj += 1
-                unmerged = [ G.nodes[v]["data"] for v in list(comp)]
                 merged = combine_merged_dict(unmerged)
                 merged_queue.put(merged) 
             print("Final flushing {} raw fragments --> {} merged fragments".format(input_obj, output_obj))
@@ -7,8 +7,10 @@ Created on Sun May 15 15:17:59 2022
 """
 import queue
 import time
+import heapq
+import numpy as np
 
-from utils.utils_mcf import MOTGraphSingle
+from utils.utils_mcf import MOTGraphSingle, MOTGraphArray, MOTGraphOffline
 from utils.misc import calc_fit, find_overlap_idx
 from utils.utils_opt import combine_fragments, resample
 # import multiprocessing
@@ -31,7 +33,10 @@ def min_cost_flow_online_alt_path(direction, fragment_queue, stitched_trajectory
     TIME_WIN = parameters["time_win"]
     
     # Initialize tracking graph
-    m = MOTGraphSingle(direction=direction, attr=ATTR_NAME, parameters=parameters)
+    if parameters["stitcher_graph"] == "array":
+        m = MOTGraphArray(direction=direction, attr=ATTR_NAME, parameters=parameters)
+    else:
+        m = MOTGraphSingle(direction=direction, attr=ATTR_NAME, parameters=parameters)
     
     GET_TIMEOUT = parameters["stitcher_timeout"]
     HB = parameters["log_heartbeat"]
@@ -69,7 +74,7 @@ def min_cost_flow_online_alt_path(direction, fragment_queue, stitched_trajectory
             all_paths = m.pop_path(time_thresh = fgmt["first_timestamp"] - TIME_WIN)  
             
             num_cache = len(m.cache)
-            num_nodes = m.G.number_of_nodes()
+            num_nodes = m.number_of_nodes()
             
             for path in all_paths:
                 # print("pop path", path)
@@ -83,8 +88,9 @@ def min_cost_flow_online_alt_path(direction, fragment_queue, stitched_trajectory
             # heartbeat log
             now = time.time()
             if now - begin > HB:
-                print("MCF graph # nodes: {}, # edges: {}, deque: {}, cache: {}".format(m.G.number_of_nodes(), m.G.number_of_edges(), len(m.in_graph_deque), len(m.cache)))
+                print("MCF graph # nodes: {}, # edges: {}, deque: {}, cache: {}".format(m.number_of_nodes(), m.number_of_edges(), len(m.in_graph_deque), len(m.cache)))
                 print("{} raw fragments --> {} stitched fragments".format(input_obj, output_obj))
+                print("stitch_cost evaluated {}, skipped {} unreachable".format(m.cost_evals, m.cost_skipped))
                 begin = time.time()
             
         except (ConnectionResetError, BrokenPipeError, EOFError) as e:   
@@ -111,6 +117,233 @@ def min_cost_flow_online_alt_path(direction, fragment_queue, stitched_trajectory
  
  
 
+def min_cost_flow_offline(direction, fragment_queue, stitched_trajectory_queue, parameters, name=None):
+    '''
+    stitcher_mode "offline": read all fragments until fragment_queue times out, then solve the stitching globally (MOTGraphOffline)
+    same input and output as min_cost_flow_online_alt_path
+    the online algorithm is replayed on the same edges to report the objective gap
+    '''
+    if not name:
+        name = "stitcher_"+direction
+    print(f"{name} | min_cost_flow_offline starts")
+    
+    ATTR_NAME = parameters["fragment_attr_name"]
+    TIME_WIN = parameters["time_win"]
+    GET_TIMEOUT = parameters["stitcher_timeout"]
+    m = MOTGraphOffline(direction=direction, attr=ATTR_NAME, parameters=parameters)
+    
+    while True:
+        try:
+            fgmt = fragment_queue.get(timeout = GET_TIMEOUT)
+        except queue.Empty:
+            print("Getting from fragment_queue timed out after {} sec.".format(GET_TIMEOUT))
+            break
+        except (ConnectionResetError, BrokenPipeError, EOFError) as e:   
+            print("Connection error: {}".format(str(e)))
+            break
+        m.add_node(fgmt)
+    
+    print("MCF offline graph # nodes: {}, # edges: {}".format(m.number_of_nodes(), m.number_of_edges()))
+    print("stitch_cost evaluated {}, skipped {} unreachable".format(m.cost_evals, m.cost_skipped))
+    start = time.time()
+    all_paths, objective = m.solve()
+    print("Offline solve took {:.2f} sec".format(time.time()-start))
+    
+    # online algorithm on the same edges
+    online = MOTGraphArray(direction=direction, attr=ATTR_NAME, parameters=parameters)
+    online.stitch_candidates = lambda fragment: m.edges[fragment[ATTR_NAME]].items()
+    online_paths = []
+    for fgmt in m.cache.values():
+        online.add_node(fgmt)
+        online.augment_path(fgmt[ATTR_NAME])
+        for path in online.pop_path(time_thresh = fgmt["first_timestamp"] - TIME_WIN):
+            online_paths.append(path)
+            online.clean_graph(path)
+    online_paths.extend(online.get_all_traj())
+    online_objective = sum(m.path_weight(path) for path in online_paths)
+    print("Offline objective {:.4f} ({} trajectories), online objective {:.4f} ({} trajectories), gap {:.4f}".format(
+        objective, len(all_paths), online_objective, len(online_paths), objective - online_objective))
+    
+    input_obj = 0
+    for path in all_paths:
+        trajs = m.get_traj_dicts(path)
+        stitched_trajectory_queue.put(trajs[::-1])
+        input_obj += len(path)
+    print("Final flushing {} raw fragments --> {} stitched fragments".format(input_obj, len(all_paths)))
+    print("Exit stitcher")
+    
+    return
+ 
+ 
+
+def tile_bounds(parameters):
+    '''
+    interior boundaries (in x) of the stitcher_tiles equal tiles over tile_x_range
+    tile k is [bounds[k-1], bounds[k]), the first and the last tile are unbounded outside of tile_x_range
+    '''
+    x0, x1 = parameters["tile_x_range"]
+    return np.linspace(x0, x1, parameters["stitcher_tiles"]+1)[1:-1]
+
+
+
+def route_to_tiles(direction, fragment_queue, parameters, name, *tile_queues):
+    '''
+    tiled stitching: send each fragment to the stitcher of the tile where it starts (first x_position)
+    tile_queues: one queue per tile, ordered by x
+    '''
+    if not name:
+        name = "tile_router_"+direction
+    print(f"{name} | route_to_tiles starts")
+    bounds = tile_bounds(parameters)
+    GET_TIMEOUT = parameters["stitcher_timeout"]
+    counts = [0] * len(tile_queues)
+    
+    while True:
+        try:
+            fgmt = fragment_queue.get(timeout = GET_TIMEOUT)
+        except queue.Empty:
+            print("Getting from fragment_queue timed out after {} sec.".format(GET_TIMEOUT))
+            break
+        except (ConnectionResetError, BrokenPipeError, EOFError) as e:   
+            print("Connection error: {}".format(str(e)))
+            break
+        k = np.searchsorted(bounds, fgmt["x_position"][0], side="right")
+        tile_queues[k].put(fgmt)
+        counts[k] += 1
+        
+    print("{} | fragments per tile: {}".format(name, counts))
+    return
+
+
+
+def _near_tile_boundary(trajs, bounds, overlap):
+    '''
+    True if the stitched trajectory trajs (fragments ordered in time) starts or ends within overlap of the boundaries of its tile,
+    or outside of its tile. its tile is where its fragments start
+    '''
+    k = np.searchsorted(bounds, trajs[0]["x_position"][0], side="right")
+    lo = bounds[k-1] + overlap if k > 0 else -np.inf
+    hi = bounds[k] - overlap if k < len(bounds) else np.inf
+    x_start, x_end = trajs[0]["x_position"][0], trajs[-1]["x_position"][-1]
+    return not (lo <= x_start <= hi and lo <= x_end <= hi)
+
+
+
+def _tile_fragment(trajs):
+    '''
+    a stitched trajectory as one fragment for the boundary stitcher, the original fragments are kept in "tile_members"
+    '''
+    fgmt = {key: val for key, val in trajs[0].items() if key not in ("head_fit", "tail_fit")}
+    for key in ("timestamp", "x_position", "y_position"):
+        fgmt[key] = np.concatenate([traj[key] for traj in trajs])
+    fgmt["last_timestamp"] = trajs[-1]["last_timestamp"]
+    fgmt["tile_members"] = trajs
+    return fgmt
+
+
+
+def stitch_tile_boundaries(direction, tile_trajectory_queue, stitched_trajectory_queue, parameters, name=None):
+    '''
+    master pass of the tiled stitching
+    trajectories from the tile stitchers that are near a tile boundary (_near_tile_boundary) are stitched again, each as one
+    fragment, by an online stitcher that runs as they arrive. the other trajectories are passed through as they come
+    a tile outputs a trajectory once it ends, so the trajectory that continues it in the next tile can arrive up to
+    tile_hold (sec, about the time to cross a tile) later:
+        - arrivals are fed to the graph in the order of last_timestamp, once the tiles are time_win past them
+        - boundary trajectories stay stitch candidates for time_win + tile_hold after that, and are then output
+    stitch_cost is still limited to gaps of time_win. in stitcher_mode "offline" the tiles output everything at the end,
+    the boundary trajectories are then stitched with min_cost_flow_offline
+    '''
+    if not name:
+        name = "boundary_stitcher_"+direction
+    print(f"{name} | stitch_tile_boundaries starts")
+    bounds = tile_bounds(parameters)
+    OVERLAP = parameters["tile_overlap"]
+    ATTR_NAME = parameters["fragment_attr_name"]
+    TIME_WIN = parameters["time_win"]
+    GET_TIMEOUT = 2 * parameters["stitcher_timeout"] # the tile stitchers flush after their own stitcher_timeout
+    HB = parameters["log_heartbeat"]
+    begin = time.time()
+    offline = parameters["stitcher_mode"] == "offline"
+    
+    if parameters["stitcher_graph"] == "array":
+        m = MOTGraphArray(direction=direction, attr=ATTR_NAME, parameters=parameters)
+    else:
+        m = MOTGraphSingle(direction=direction, attr=ATTR_NAME, parameters=parameters)
+    m.keep_win = TIME_WIN + parameters["tile_hold"]
+    
+    arrived = [] # (last_timestamp, arrival order, fragment) of the boundary trajectories not in the graph yet
+    latest = -np.inf # last_timestamp of the newest trajectory from the tiles
+    passed = 0
+    boundary = 0
+    output_obj = 0
+    
+    def put_path(path):
+        stitched_trajectory_queue.put([traj for fgmt in m.get_traj_dicts(path)[::-1] for traj in fgmt["tile_members"]])
+    
+    def stitch(fgmt):
+        m.add_node(fgmt)
+        m.augment_path(fgmt[ATTR_NAME])
+    
+    while True:
+        try:
+            trajs = tile_trajectory_queue.get(timeout = GET_TIMEOUT)
+        except queue.Empty:
+            print("Getting from tile_trajectory_queue timed out after {} sec.".format(GET_TIMEOUT))
+            break
+        except (ConnectionResetError, BrokenPipeError, EOFError) as e:   
+            print("Connection error: {}".format(str(e)))
+            break
+        
+        latest = max(latest, trajs[-1]["last_timestamp"])
+        if _near_tile_boundary(trajs, bounds, OVERLAP):
+            fgmt = _tile_fragment(trajs)
+            heapq.heappush(arrived, (fgmt["last_timestamp"], boundary, fgmt))
+            boundary += 1
+        else:
+            stitched_trajectory_queue.put(trajs)
+            passed += 1
+        
+        if not offline:
+            # everything that ends before latest - TIME_WIN is in the graph
+            while arrived and arrived[0][0] < latest - TIME_WIN:
+                stitch(heapq.heappop(arrived)[2])
+            for path in m.pop_path(time_thresh = latest - TIME_WIN - m.keep_win):
+                put_path(path)
+                m.clean_graph(path)
+                output_obj += 1
+        
+        now = time.time()
+        if now - begin > HB:
+            print("{} | graph # nodes: {}, waiting: {}, {} passed through, {} near tile boundaries --> {} stitched trajectories".format(
+                name, m.number_of_nodes(), len(arrived), passed, boundary, output_obj))
+            begin = now
+    
+    if offline:
+        # stitch the boundary trajectories in the order of last_timestamp, as the raw fragments are read
+        fragment_queue = queue.Queue()
+        while arrived:
+            fragment_queue.put(heapq.heappop(arrived)[2])
+        boundary_queue = queue.Queue()
+        boundary_param = dict(parameters)
+        boundary_param["stitcher_timeout"] = 0
+        min_cost_flow_offline(direction, fragment_queue, boundary_queue, boundary_param, name = name)
+        while not boundary_queue.empty():
+            stitched_trajectory_queue.put([traj for fgmt in boundary_queue.get() for traj in fgmt["tile_members"]])
+            output_obj += 1
+    else:
+        while arrived:
+            stitch(heapq.heappop(arrived)[2])
+        for path in m.get_all_traj():
+            put_path(path)
+            output_obj += 1
+    
+    print("{} | {} trajectories passed through, {} near tile boundaries --> {} stitched trajectories".format(
+        name, passed, boundary, output_obj))
+    return
+ 
+ 
+
 if __name__ == '__main__':
 
     
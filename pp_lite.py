@@ -17,6 +17,7 @@ import data_feed as df
 import min_cost_flow as mcf
 import reconciliation as rec
 import merge
+from utils.shm_queue import ShmQueue
 
 
 
@@ -43,6 +44,10 @@ def main(raw_collection = None, reconciled_collection = None):
     print("Post-processing manager has PID={}".format(os.getpid()))
 
     # SHARED DATA STRUCTURES
+    if parameters["queue_transport"] == "shm": # arrays through shared memory, see utils/shm_queue.py
+        make_queue = lambda: ShmQueue(capacity=parameters["shm_queue_capacity"]*2**20)
+    else:
+        make_queue = mp_manager.Queue
     mp_param = mp_manager.dict()
     mp_param.update(parameters)
     mp_param["time_win"] = mp_param["master_time_win"]
@@ -56,36 +61,65 @@ def main(raw_collection = None, reconciled_collection = None):
     # -- master processes (not videonode specific) START AFTER ALL THE LOCAL PROCESSES DIE
     master_queues_map = {} # key:proc_name, val:queue that this process writes to
     for dir in directions:
-        master_queues_map[f"master_{dir}_feed"] = mp_manager.Queue() 
-        master_queues_map[f"master_{dir}_merge"] = mp_manager.Queue() 
-    master_queues_map["master_stitch"] = mp_manager.Queue() 
-    master_queues_map["master_reconcile"] = mp_manager.Queue() 
+        master_queues_map[f"master_{dir}_feed"] = make_queue()
+        master_queues_map[f"master_{dir}_merge"] = make_queue()
+    master_queues_map["master_stitch"] = make_queue()
+    master_queues_map["master_reconcile"] = make_queue()
     
     master_proc_map = defaultdict(dict)
     
+    # feed: parse the raw collection once and route fragments to eb/wb queues by direction
+    master_proc_map["master_feed"]["command"] = df.static_data_reader_split
+    master_proc_map["master_feed"]["args"] = (mp_param, db_param, master_queues_map["master_eb_feed"], 
+                                              master_queues_map["master_wb_feed"], "master_feed",)
+    master_proc_map["master_feed"]["predecessor"] = None
+    master_proc_map["master_feed"]["dependent_queue"] = None
+    
     for dir in directions:
         
-        # feed
         key1 = "master_"+dir+"_feed"
-        master_proc_map[key1]["command"] = df.static_data_reader # TODO: modify data_feed
-        master_proc_map[key1]["args"] = (mp_param, db_param, master_queues_map[key1], 
-                                         {"direction":1 if dir=="eb" else -1},) # qeury from raw collection
-        master_proc_map[key1]["predecessor"] = None
-        master_proc_map[key1]["dependent_queue"] = None
         
         # merge
         key2 =  "master_"+dir+"_merge"
         master_proc_map[key2]["command"] = merge.merge_fragments 
         master_proc_map[key2]["args"] = (dir, master_queues_map[key1], master_queues_map[key2] , mp_param, key2, ) 
-        master_proc_map[key2]["predecessor"] = [key1]
+        master_proc_map[key2]["predecessor"] = ["master_feed"]
         master_proc_map[key2]["dependent_queue"] = [master_queues_map[key1]]
         
         # stitch
         key3 = "master_"+dir+"_stitch"
-        master_proc_map[key3]["command"] = mcf.min_cost_flow_online_alt_path
-        master_proc_map[key3]["args"] = (dir, master_queues_map[key2], master_queues_map["master_stitch"], mp_param, key3,)
-        master_proc_map[key3]["predecessor"] = [key2]
-        master_proc_map[key3]["dependent_queue"] = [master_queues_map[key2]]
+        stitcher = mcf.min_cost_flow_offline if parameters["stitcher_mode"] == "offline" else mcf.min_cost_flow_online_alt_path
+        if parameters["stitcher_tiles"] == 1:
+            master_proc_map[key3]["command"] = stitcher
+            master_proc_map[key3]["args"] = (dir, master_queues_map[key2], master_queues_map["master_stitch"], mp_param, key3,)
+            master_proc_map[key3]["predecessor"] = [key2]
+            master_proc_map[key3]["dependent_queue"] = [master_queues_map[key2]]
+        
+        else:
+            # tiled stitch: route fragments to one stitcher per x-range tile, then stitch across the tile boundaries
+            tile_keys = [f"master_{dir}_tile{k}" for k in range(parameters["stitcher_tiles"])]
+            for tile_key in tile_keys:
+                master_queues_map[tile_key] = make_queue()
+            master_queues_map[key3+"_tiles"] = make_queue()
+            
+            key_route = "master_"+dir+"_route"
+            master_proc_map[key_route]["command"] = mcf.route_to_tiles
+            master_proc_map[key_route]["args"] = (dir, master_queues_map[key2], mp_param, key_route, 
+                                                  *[master_queues_map[tile_key] for tile_key in tile_keys],)
+            master_proc_map[key_route]["predecessor"] = [key2]
+            master_proc_map[key_route]["dependent_queue"] = [master_queues_map[key2]]
+            
+            for tile_key in tile_keys:
+                key_tile = tile_key+"_stitch"
+                master_proc_map[key_tile]["command"] = stitcher
+                master_proc_map[key_tile]["args"] = (dir, master_queues_map[tile_key], master_queues_map[key3+"_tiles"], mp_param, key_tile,)
+                master_proc_map[key_tile]["predecessor"] = [key_route]
+                master_proc_map[key_tile]["dependent_queue"] = [master_queues_map[tile_key]]
+            
+            master_proc_map[key3]["command"] = mcf.stitch_tile_boundaries
+            master_proc_map[key3]["args"] = (dir, master_queues_map[key3+"_tiles"], master_queues_map["master_stitch"], mp_param, key3,)
+            master_proc_map[key3]["predecessor"] = [tile_key+"_stitch" for tile_key in tile_keys]
+            master_proc_map[key3]["dependent_queue"] = [master_queues_map[key3+"_tiles"]]
     
     
     
@@ -157,6 +191,9 @@ def main(raw_collection = None, reconciled_collection = None):
             start = time.time()
                 
     
+    for q in master_queues_map.values():
+        if isinstance(q, ShmQueue):
+            q.unlink()
     print("postproc_manager | MASTER Postprocessing Mischief Managed.")
     
     
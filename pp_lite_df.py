@@ -45,7 +45,7 @@ def main(raw_collection = None, reconciled_collection = None):
     
     # CREATE A MANAGER
     # mp_manager = mp.Manager()
-    sm = StreamManager()
+    sm = StreamManager(parameters["queue_transport"], parameters["shm_queue_capacity"])
     print("Post-processing manager has PID={}".format(os.getpid()))
 
     # SHARED DATA STRUCTURES
@@ -58,13 +58,12 @@ def main(raw_collection = None, reconciled_collection = None):
     # initialize some db collections
     print("Post-processing manager initialized db collections. Creating shared data structures")
     master_stitch: list[StreamSeries] = []
-    for dir in ("eb", "wb"):
-        
-        # feed
-        print('feed', dir)
-        key1 = "master_"+dir+"_feed"
-        query_filter = {"direction": 1 if dir == "eb" else -1}
-        master_feed = sm.pipe(df.static_data_reader, 2)(sm.param, db_param, query_filter, name=key1)
+    
+    # feed: parse the raw collection once and route fragments to eb/wb queues by direction
+    print('feed')
+    master_feeds = sm.pipe(df.static_data_reader_split, 2, num_outputs=2)(sm.param, db_param, "master_feed", name="master_feed")
+    
+    for dir, master_feed in zip(("eb", "wb"), master_feeds):
         
         # merge
         print('merge', dir)
@@ -74,7 +73,16 @@ def main(raw_collection = None, reconciled_collection = None):
         # stitch
         print('stitch', dir)
         key3 = "master_"+dir+"_stitch"
-        master_stitch.append(sm.pipe(mcf.min_cost_flow_online_alt_path, 2)(dir, master_merge, parameters, key3, name=key3))
+        stitcher = mcf.min_cost_flow_offline if parameters["stitcher_mode"] == "offline" else mcf.min_cost_flow_online_alt_path
+        if parameters["stitcher_tiles"] == 1:
+            master_stitch.append(sm.pipe(stitcher, 2)(dir, master_merge, parameters, key3, name=key3))
+        else:
+            # tiled stitch: route fragments to one stitcher per x-range tile, then stitch across the tile boundaries
+            key_route = "master_"+dir+"_route"
+            tiles = sm.pipe(mcf.route_to_tiles, 4, num_outputs=parameters["stitcher_tiles"])(dir, master_merge, parameters, key_route, name=key_route)
+            tile_stitch = [sm.pipe(stitcher, 2)(dir, tile, parameters, f"master_{dir}_tile{k}_stitch", name=f"master_{dir}_tile{k}_stitch") 
+                           for k, tile in enumerate(tiles)]
+            master_stitch.append(sm.pipe(mcf.stitch_tile_boundaries, 2)(dir, sm.merge_queues(*tile_stitch), parameters, key3, name=key3))
     
     print('merge stitched trajectories from east bound and west bound')
     merged_master_stiched = sm.merge_queues(*master_stitch)
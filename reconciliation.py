@@ -6,6 +6,9 @@ __doc__ = """
 # -----------------------------
 import multiprocessing
 from multiprocessing import Pool
+import threading
+import itertools
+from functools import partial
 import time
 import os
 import queue
@@ -24,33 +27,59 @@ class DecimalEncoder(json.JSONEncoder):
         return super().default(o)
     
     
+def reconcile_trajectory(reconciliation_args, combined_trajectory):
+    """
+    Resample and reconcile a single trajectory
+    :return: the reconciled trajectory, None if it is skipped
+    """
+    try:
+        resampled_trajectory = resample(combined_trajectory, dt=0.04)
+        if "post_flag" in resampled_trajectory:
+            # skip reconciliation
+            print("+++ Flag as low conf, skip reconciliation")
+            return None
+        return opt2_l1_constr(resampled_trajectory, **reconciliation_args)
+    except Exception as e:
+        print("+++ Flag as {}, skip reconciliation".format(str(e)))
+        return None
+
+
 def reconcile_single_trajectory(reconciliation_args, combined_trajectory, reconciled_queue) -> None:
     """
     Resample and reconcile a single trajectory, and write the result to a queue
     :param next_to_reconcile: a trajectory document
     :return:
     """
-    
+    finished_trajectory = reconcile_trajectory(reconciliation_args, combined_trajectory)
+    if finished_trajectory is not None:
+        reconciled_queue.put(finished_trajectory)
 
-    resampled_trajectory = resample(combined_trajectory, dt=0.04)
-    if "post_flag" in resampled_trajectory:
-        # skip reconciliation
-        print("+++ Flag as low conf, skip reconciliation")
 
-    else:
+def reconcile_batch(reconciliation_args, stitched_trajectories):
+    """
+    Combine and reconcile a batch of stitched trajectories (lists of fragments) in one worker task
+    A trajectory that fails is skipped, the others in the batch are still reconciled
+    :return: list of the reconciled trajectories, skipped ones are left out
+    """
+    finished_trajectories = []
+    for traj_docs in stitched_trajectories:
         try:
-            finished_trajectory = opt2_l1_constr(resampled_trajectory, **reconciliation_args)  
-            reconciled_queue.put(finished_trajectory)
-           
+            combined_trajectory = combine_fragments(traj_docs if isinstance(traj_docs, list) else [traj_docs])
         except Exception as e:
             print("+++ Flag as {}, skip reconciliation".format(str(e)))
-
+            continue
+        finished_trajectory = reconcile_trajectory(reconciliation_args, combined_trajectory)
+        if finished_trajectory is not None:
+            finished_trajectories.append(finished_trajectory)
+    return finished_trajectories
 
 
 def reconciliation_pool(parameters, db_param, stitched_trajectory_queue: multiprocessing.Queue, 
                         reconciled_queue: multiprocessing.Queue, ) -> None:
     """
-    Start a multiprocessing pool, each worker 
+    Start a multiprocessing pool, each worker reconciles batches of up to reconciliation_batch_size trajectories
+    Results come back through the pool's result pipe and are forwarded to reconciled_queue
+    At most reconciliation_in_flight batches per worker are dispatched and not yet returned
     :param stitched_trajectory_queue: results from stitchers, shared by mp.manager
     :param pid_tracker: a dictionary
     :return:
@@ -62,6 +91,10 @@ def reconciliation_pool(parameters, db_param, stitched_trajectory_queue: multipr
     
     # parameters
     reconciliation_args=parameters["reconciliation_args"]
+    if parameters["reconciliation_mode"] == "receding_horizon":
+        reconciliation_args = dict(reconciliation_args, ph=parameters["ph"], ih=parameters["ih"])
+    BATCH_SIZE = parameters["reconciliation_batch_size"]
+    in_flight = threading.BoundedSemaphore(parameters["reconciliation_in_flight"] * n_proc)
 
     # wait to get raw collection name
     while parameters["raw_collection"]=="":
@@ -70,105 +103,226 @@ def reconciliation_pool(parameters, db_param, stitched_trajectory_queue: multipr
     print("** Reconciliation pool starts. Pool size: {}".format(n_proc))
     TIMEOUT = parameters["reconciliation_pool_timeout"]
     
-    cntr = 0
-    while True:
-        try:
+    def batches():
+        # runs in the pool's task handler thread, blocks while too many batches are in flight
+        while True:
             try:
                 traj_docs = stitched_trajectory_queue.get(timeout = TIMEOUT) #20sec
-                cntr += 1
             except queue.Empty: 
                 print("Reconciliation pool is timed out after {}s. Close the reconciliation pool.".format(TIMEOUT))
-                worker_pool.close()
-                break
-            if isinstance(traj_docs, list):
-                combined_trajectory = combine_fragments(traj_docs)
-            else:
-                combined_trajectory = combine_fragments([traj_docs])
-            # combined_trajectory = combine_fragments(traj_docs)  
-            worker_pool.apply_async(reconcile_single_trajectory, (reconciliation_args, combined_trajectory, reconciled_queue, ))
-
-        except Exception as e: # other exception
-            print("{}, Close the pool".format(e))
-            worker_pool.close() # wait until all processes finish their task
+                return
+            batch = [traj_docs]
+            # fill up the batch with what is already queued, do not wait for more
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(stitched_trajectory_queue.get_nowait())
+                except queue.Empty:
+                    break
+            in_flight.acquire() # released as the results come back
+            yield batch
+    
+    cntr = 0
+    results = worker_pool.imap_unordered(partial(reconcile_batch, reconciliation_args), batches())
+    while True:
+        # keep collecting after an error, the other batches are still being reconciled
+        try:
+            finished_trajectories = next(results)
+        except StopIteration:
             break
+        except Exception as e: # other exception
+            print("{}, skip the batch".format(e))
+            in_flight.release()
+            continue
+        in_flight.release()
+        try:
+            if finished_trajectories:
+                reconciled_queue.put(finished_trajectories) # one proxy call per batch
+            cntr += len(finished_trajectories)
+        except Exception as e:
+            print("{}, dropped {} reconciled trajectories".format(e, len(finished_trajectories)))
+    worker_pool.close() # wait until all processes finish their task
             
             
         
     # Finish up  
     worker_pool.join()
-    print("Joined the pool.")
+    print("Joined the pool. Reconciled {} trajectories.".format(cntr))
     
     return
 
 
 
 def write_reconciled_to_db(parameters, db_param, reconciled_queue):
-    
+    """
+    Write the reconciled trajectories to reconciled_collection.json (a JSON array) or .ndjson (one document per line),
+    depending on output_format, through one open file (see BufferedJsonWriter)
+    A restarted writer appends to the file
+    """
         
     TIMEOUT = parameters["reconciliation_writer_timeout"]
     cntr = 0
     HB = parameters["log_heartbeat"]
     begin = time.time()
 
-    # in case of restart, remove the last "]" in json
-    output_filename = parameters["reconciled_collection"]+".json"
-    file_exists = os.path.exists(output_filename)
-    append_flag = file_exists and os.stat(output_filename).st_size > 0
+    ndjson = parameters["output_format"] == "ndjson"
+    output_filename = parameters["reconciled_collection"]+(".ndjson" if ndjson else ".json")
     
-    if append_flag:
-        with open(output_filename, 'rb+') as fh:
-            fh.seek(-1, os.SEEK_END)
-            fh.truncate()
-        print("removed last character")
-
-    # Write to db
-    while True:
-
-        try:
-            record = reconciled_queue.get(timeout = TIMEOUT)
-        except queue.Empty:
-            print("Getting from reconciled_queue reaches timeout {} sec.".format(TIMEOUT))
-            break
-
-        # TODO: write one
-        file_exists = os.path.exists(output_filename)
-        append_flag = file_exists and os.stat(output_filename).st_size > 0
-
-        # Open the output file for writing or appending
-        with open(output_filename, 'a' if file_exists else 'w') as output_file:
-            # If the file doesn't exist or is empty, write the start of the JSON array
-            if not append_flag:
-                output_file.write("[")
-
-            # Check if the file already had data and adjust the comma if needed
-            first_item = True if not file_exists or os.stat(output_filename).st_size == 0 else False
-
-            if not first_item:
-                output_file.write(",")  # Separate items with commas except for the first one
-            else:
-                first_item = False
-            
-            # Write each record (dictionary) to the output file using the custom encoder
-            json.dump(record, output_file, cls=DecimalEncoder)
-            cntr += 1
-            output_file.write("]")  # Close the JSON array
-        
+    with BufferedJsonWriter(output_filename, ndjson=ndjson, buffer_size=parameters["writer_buffer_size"]*2**20) as writer:
+        while True:
+            try:
+                records = reconciled_queue.get(timeout = TIMEOUT)
+            except queue.Empty:
+                print("Getting from reconciled_queue reaches timeout {} sec.".format(TIMEOUT))
+                break
+            if not isinstance(records, list): # reconciliation_pool puts whole batches
+                records = [records]
 
-        if time.time()-begin > HB:
-            begin = time.time()
-            
-            # TODO: progress update
-            print(f"Writing {cntr} documents in this batch")
-            
+            for record in records:
+                writer.write(record)
+                cntr += 1
 
+            if time.time()-begin > HB:
+                begin = time.time()
+                writer.flush() # bound what a crash of the writer can lose
+                print(f"Writing {cntr} documents in this batch")
     
-    # Safely close the mongodb client connection
     print(f"JSON writer closed. Current count: {cntr}. Exit")
     return
 
 
 
+class BufferedJsonWriter:
+    """
+    Append documents to a JSON array file, or to an NDJSON file, through one open file handle
+    Documents are encoded into a buffer that goes to the file in one write once it holds buffer_size bytes, 
+    and on flush() and close()
+    The JSON array is written one document per line: "[\\n" doc ",\\n" doc "\\n]\\n". Every write ends with the closing
+    "]", so the file is valid JSON unless the process dies in the middle of a write. Opening an existing file
+    drops a document that was cut off at the end, and appends to the array, also to a one line array
+    written by the previous writer
+    """
+    FOOTER = b"\n]\n"
+    
+    def __init__(self, filename, ndjson=False, buffer_size=4*2**20):
+        self.filename = filename
+        self.ndjson = ndjson
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        if not os.path.exists(filename):
+            open(filename, "wb").close()
+        # the JSON array is written in place over its footer, append mode would ignore the seek
+        self._fh = open(filename, "a+b" if ndjson else "r+b", buffering=0)
+        if ndjson:
+            self._end = self._repair_ndjson()
+        else:
+            self._end, self._first = self._repair_json()
+    
+    def write(self, record):
+        line = json.dumps(record, cls=DecimalEncoder).encode()
+        self._buffer.append(line)
+        self._buffered += len(line)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+    
+    def flush(self):
+        if not self._buffer:
+            return
+        if self.ndjson:
+            data = b"\n".join(self._buffer)+b"\n"
+            self._fh.write(data)
+        else:
+            data = (b"\n" if self._first else b",\n") + b",\n".join(self._buffer)
+            self._fh.seek(self._end)
+            self._fh.write(data+self.FOOTER)
+            self._first = False
+        self._end += len(data)
+        self._buffer, self._buffered = [], 0
+    
+    def close(self):
+        self.flush()
+        self._fh.close()
+    
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+    
+    def _last_newline(self, end):
+        # offset of the last b"\n" before end, -1 if there is none
+        pos = end
+        while pos > 0:
+            start = max(0, pos-2**20)
+            self._fh.seek(start)
+            i = self._fh.read(pos-start).rfind(b"\n")
+            if i >= 0:
+                return start+i
+            pos = start
+        return -1
     
+    def _last_content(self, end):
+        # offset of the last byte before end that is not whitespace, -1 if there is none
+        pos = end
+        while pos > 0:
+            start = max(0, pos-2**20)
+            self._fh.seek(start)
+            chunk = self._fh.read(pos-start).rstrip()
+            if chunk:
+                return start+len(chunk)-1
+            pos = start
+        return -1
+    
+    def _repair_ndjson(self):
+        size = os.path.getsize(self.filename)
+        end = self._last_newline(size)+1
+        if end < size:
+            print("{}: dropped {} bytes of an incomplete document at the end".format(self.filename, size-end))
+            os.truncate(self.filename, end)
+        return end
+    
+    def _repair_json(self):
+        size = os.path.getsize(self.filename)
+        self._fh.seek(0)
+        if size == 0 or self._fh.read(1) != b"[":
+            if size > 0: # not written by this class, keep it
+                os.replace(self.filename, self.filename+".bak")
+                print("{} is not a JSON array, moved to {}.bak".format(self.filename, self.filename))
+                self._fh.close()
+                self._fh = open(self.filename, "w+b", buffering=0)
+            self._fh.write(b"["+self.FOOTER)
+            return 1, True
+        
+        last = self._last_content(size)
+        self._fh.seek(last)
+        closed = last > 0 and self._fh.read(1) == b"]"
+        if closed:
+            # the "]" closes the array if it is on a line of its own, or if the file is one line as the previous
+            # writer made it ("[doc,doc]"), then append after the last document. otherwise it ends a list in a
+            # document that was cut off
+            end = self._last_content(last)+1
+            newline = self._last_newline(last)
+            closed = newline < 0 or end <= newline
+        if not closed:
+            # cut off in a write: keep the last line only if it is a complete document
+            end = self._last_newline(size)
+            self._fh.seek(end+1)
+            line = self._fh.read().rstrip().rstrip(b",")
+            try:
+                if isinstance(json.loads(line), dict):
+                    end += 1+len(line)
+            except ValueError:
+                pass
+            end = self._last_content(max(end, 1))+1
+            self._fh.seek(end-1)
+            if self._fh.read(1) == b",":
+                end -= 1
+            print("{}: dropped {} bytes of an incomplete document at the end".format(self.filename, size-end))
+        os.truncate(self.filename, end)
+        self._fh.seek(end)
+        self._fh.write(self.FOOTER)
+        return end, end == 1
+            
     
     
     
@@ -176,4 +330,92 @@ def write_reconciled_to_db(parameters, db_param, reconciled_queue):
     
 
 if __name__ == '__main__':
-    print("not implemented")
+    # python reconciliation.py [RAW_i] [n_fragments]
+    # reconcile raw fragments through Manager queues, one apply_async per trajectory vs reconciliation_pool, and time both
+    # then time writing the results
+    import sys
+    import ijson
+    
+    with open("parameters.json") as f:
+        parameters = json.load(f)
+    raw_collection = sys.argv[1] if len(sys.argv) > 1 else parameters["raw_collection"]
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with open(raw_collection+".json", "rb") as f:
+        docs = list(itertools.islice((doc for doc in ijson.items(f, "item", use_float=True) if len(doc["timestamp"]) > 3), n))
+    parameters["reconciliation_pool_timeout"] = 0.1
+    parameters["raw_collection"] = raw_collection
+    n_proc = min(multiprocessing.cpu_count(), parameters["worker_size"])
+    
+    manager = multiprocessing.Manager()
+    stitched_trajectory_queue, reconciled_queue = manager.Queue(), manager.Queue()
+    
+    for mode in ["apply_async", "batched"]:
+        for doc in docs:
+            stitched_trajectory_queue.put([doc])
+        t0 = time.time()
+        if mode == "apply_async":
+            worker_pool = Pool(processes=n_proc)
+            while True:
+                try:
+                    traj_docs = stitched_trajectory_queue.get(timeout=parameters["reconciliation_pool_timeout"])
+                except queue.Empty:
+                    break
+                worker_pool.apply_async(reconcile_single_trajectory, (parameters["reconciliation_args"], combine_fragments(traj_docs), reconciled_queue, ))
+            worker_pool.close()
+            worker_pool.join()
+        else:
+            reconciliation_pool(parameters, None, stitched_trajectory_queue, reconciled_queue)
+        elapsed = time.time()-t0
+        reconciled = []
+        while not reconciled_queue.empty():
+            records = reconciled_queue.get()
+            reconciled.extend(records if isinstance(records, list) else [records])
+        print("{}: {} fragments, {} reconciled, {:.2f} sec, {:.0f} trajectories/sec".format(mode, len(docs), len(reconciled), elapsed, len(docs)/elapsed))
+    
+    # write the reconciled trajectories 10 times, reopening the file for every document as write_reconciled_to_db did
+    # before, and with BufferedJsonWriter
+    output_filename = parameters["reconciled_collection"]+"_bench.json"
+    records = reconciled * 10
+    for mode in ["reopen", "buffered"]:
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+        t0 = time.time()
+        if mode == "reopen":
+            for record in records:
+                file_exists = os.path.exists(output_filename)
+                with open(output_filename, 'a' if file_exists else 'w') as output_file:
+                    output_file.write("," if file_exists and os.stat(output_filename).st_size > 0 else "[")
+                    json.dump(record, output_file, cls=DecimalEncoder)
+            with open(output_filename, 'a') as output_file:
+                output_file.write("]")
+        else:
+            with BufferedJsonWriter(output_filename, buffer_size=parameters["writer_buffer_size"]*2**20) as writer:
+                for record in records:
+                    writer.write(record)
+        elapsed = time.time()-t0
+        size = os.path.getsize(output_filename)
+        with open(output_filename) as f:
+            assert len(json.load(f)) == len(records)
+        print("{}: {} documents, {:.2f} sec, {:.0f} documents/sec, {:.0f} MB/s".format(mode, len(records), elapsed, len(records)/elapsed, size/elapsed/2**20))
+    os.remove(output_filename)
+    
+    # restart the writer on files left by this class, by the previous writer and by crashes, check that they parse
+    cases = [("", []),
+             ("[\n]\n", []),
+             ('[\n{"a": 1},\n{"a": 2}\n]\n', [{"a": 1}, {"a": 2}]),
+             ('[{"a": 1},{"a": 2}]', [{"a": 1}, {"a": 2}]), # previous writer
+             ('[{"a": 1},{"a": 2}]\n', [{"a": 1}, {"a": 2}]),
+             ('[{"a": 1},{"a": 2}', []), # previous writer, cut off in the middle of the line
+             ('[\n{"a": 1},\n{"a": 2}', [{"a": 1}, {"a": 2}]),
+             ('[\n{"a": 1},\n{"a": 2},', [{"a": 1}, {"a": 2}]),
+             ('[\n{"a": 1},\n{"a": [1, 2]', [{"a": 1}]),
+             ('[\n{"a": 1},\n{"a": [1, 2]}\n', [{"a": 1}, {"a": [1, 2]}])]
+    for content, kept in cases:
+        with open(output_filename, "w") as f:
+            f.write(content)
+        with BufferedJsonWriter(output_filename) as writer:
+            writer.write({"a": 3})
+        with open(output_filename) as f:
+            assert json.load(f) == kept+[{"a": 3}], content
+    os.remove(output_filename)
+    print("writer restarts ok")
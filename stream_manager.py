@@ -4,6 +4,8 @@ import time
 from collections import defaultdict
 from uuid import uuid4
 
+from utils.shm_queue import ShmQueue
+
 
 class StreamSeries:
     def __init__(self, queue: "queue.Queue", proc_name: list[str]):
@@ -20,14 +22,22 @@ class StreamSeries:
 
 
 class StreamManager:
-    def __init__(self):
+    def __init__(self, queue_transport: str = "manager", shm_queue_capacity: int = 32):
+        """
+        queue_transport: "manager" connects the stages with Manager queues, "shm" with ShmQueue
+        (arrays through shared memory, shm_queue_capacity MB per queue)
+        """
         self._mp_manager = mp.Manager()
+        self.queue_transport = queue_transport
+        self.shm_queue_capacity = shm_queue_capacity
         self.queues_map = {}
         self.proc_map = defaultdict(dict)
         self.pid_tracker = {}
         self.param = self._mp_manager.dict()
     
     def get_queue(self):
+        if self.queue_transport == "shm":
+            return ShmQueue(capacity=self.shm_queue_capacity*2**20)
         return self._mp_manager.Queue()
     
     def __enter__(self):
@@ -92,14 +102,28 @@ class StreamManager:
                                                                             self.queues_map[proc_name].qsize()))
                 print("postproc_manager | Master processes have been running for {} sec".format(now-begin))
                 start = time.time()
-
-    def pipe(self, fn, output_idx: int | None = None):
+        
+        for q in self.queues_map.values():
+            if isinstance(q, ShmQueue):
+                q.unlink()
+
+    def pipe(self, fn, output_idx: int | None = None, num_outputs: int = 1):
+        """
+        num_outputs > 1 inserts that many result queues at output_idx and 
+        returns one StreamSeries per queue, all produced by the same process
+        """
         def _fn(*args, name: str | None = None):
-            res_queue = self.get_queue()
-            self.queues_map[name] = res_queue
+            if name is None:
+                name = str(uuid4())
+            res_queues = [self.get_queue() for _ in range(num_outputs)]
+            if num_outputs == 1:
+                self.queues_map[name] = res_queues[0]
+            else:
+                for i, res_queue in enumerate(res_queues):
+                    self.queues_map[f"{name}[{i}]"] = res_queue
             args = list(args)
             if output_idx is not None:
-                args.insert(output_idx, res_queue)
+                args[output_idx:output_idx] = res_queues
             dependent_queues: list[queue.Queue] = []
             predecessors: list[str] = []
             for i in range(len(args)):
@@ -108,8 +132,6 @@ class StreamManager:
                     args[i] = arg.queue
                     dependent_queues.append(arg.queue)
                     predecessors.extend(arg.proc_name)
-            if name is None:
-                name = str(uuid4())
             def process():
                 return mp.Process(target=fn, args=args, name=name, daemon=False)
             subsys_process = process()
@@ -119,7 +141,9 @@ class StreamManager:
             self.proc_map[name]['dependent_queue'] = dependent_queues
             self.proc_map[name]['predecessor'] = predecessors
             self.proc_map[name]['create_process'] = process
-            return StreamSeries(res_queue, [name])
+            if num_outputs == 1:
+                return StreamSeries(res_queues[0], [name])
+            return tuple(StreamSeries(res_queue, [name]) for res_queue in res_queues)
         return _fn
 
     def merge_queues(self, *stream_series: "StreamSeries"):
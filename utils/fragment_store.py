@@ -0,0 +1,74 @@
+'''
+Columnar binary store for raw fragment collections
+a store is a directory that holds
+    - one <field>.npy per time series field: all fragments concatenated, float64
+    - offsets.npy: int64 array of length n+1, fragment i is [offsets[i], offsets[i+1])
+    - meta.json: the remaining (scalar) fields of each fragment, in the same order
+fragments are written in the order they are given (sort by last_timestamp before writing)
+the arrays are memory-mapped on read, and each fragment gets read-only slices into them (no copy)
+'''
+import json
+import os
+import numpy as np
+
+
+array_fields = ["timestamp", "x_position", "y_position", "length", "width", "height", "detection_confidence", "velocity"]
+
+
+def write_store(fragments, path):
+    '''
+    fragments: list of fragment dicts, time series in array_fields must be float arrays or lists
+    path: store directory, created if it does not exist
+    '''
+    os.makedirs(path, exist_ok=True)
+    fields = [key for key in array_fields if fragments and key in fragments[0]]
+
+    lengths = [len(fragment["timestamp"]) for fragment in fragments]
+    offsets = np.zeros(len(fragments)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+
+    for key in fields:
+        arr = np.empty(offsets[-1], dtype=np.float64)
+        for i, fragment in enumerate(fragments):
+            arr[offsets[i]:offsets[i+1]] = fragment[key]
+        np.save(os.path.join(path, key+".npy"), arr)
+
+    meta = [{key: val for key, val in fragment.items() if key not in fields} for fragment in fragments]
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"fields": fields, "fragments": meta}, f)
+
+    return len(fragments)
+
+
+
+class FragmentStore:
+    '''
+    read-only view of a store written by write_store
+    iterating yields fragment dicts whose time series are zero-copy slices of the memory-mapped arrays
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.fields = meta["fields"]
+        self.meta = meta["fragments"]
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.arrays = {key: np.load(os.path.join(path, key+".npy"), mmap_mode="r") for key in self.fields}
+
+    def __len__(self):
+        return len(self.meta)
+
+    def __getitem__(self, i):
+        s, e = self.offsets[i], self.offsets[i+1]
+        fragment = dict(self.meta[i])
+        for key, arr in self.arrays.items():
+            fragment[key] = arr[s:e]
+        return fragment
+
+    def __iter__(self):
+        for i in range(len(self.meta)):
+            yield self[i]
+
+    def __repr__(self):
+        return 'FragmentStore({!r}, {} fragments)'.format(self.path, len(self))
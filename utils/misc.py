@@ -22,27 +22,76 @@ def nan_helper(y):
 
 
 
-def interpolate(traj):
+def interpolate(traj, as_array=False):
     '''
     interpolate raw trajectories to get rid of nans in x_position and y_position
     update starting_x, ending_x
+    as_array: keep x_position and y_position as numpy arrays instead of converting back to lists
     '''
-    x = np.array(traj["x_position"])
-    y = np.array(traj["y_position"])
+    x = np.array(traj["x_position"], dtype=float)
+    y = np.array(traj["y_position"], dtype=float)
     
     nans, fcn = nan_helper(x)
-    x[nans]= np.interp(fcn(nans), fcn(~nans), x[~nans])
-    y[nans]= np.interp(fcn(nans), fcn(~nans), y[~nans]) # assume missing y and missing x are at the same indices
+    if nans.any():
+        x[nans]= np.interp(fcn(nans), fcn(~nans), x[~nans])
+        y[nans]= np.interp(fcn(nans), fcn(~nans), y[~nans]) # assume missing y and missing x are at the same indices
     
     # update document
-    traj['x_position'] = list(x)
-    traj['y_position'] = list(y)
+    if as_array:
+        traj['x_position'] = x
+        traj['y_position'] = y
+    else:
+        traj['x_position'] = list(x)
+        traj['y_position'] = list(y)
     traj["starting_x"] = float(x[0])
     traj["ending_x"] = float(x[-1])
     
     return traj
 
 
+def resample_uniform(timestamp, series, dt=0.04):
+    '''
+    numpy version of the pandas resampling in merge_resample and utils_opt.resample, with the same result:
+        df.set_index(pd.to_timedelta(timestamp, unit='s')).resample('10L').mean().interpolate(method="linear").resample(dt).asfreq()
+    i.e., average into 10ms bins that start at the first timestamp, linearly interpolate the bins
+    (leading nans are kept, trailing nans take the last valid value), then take every dt-th bin
+    timestamp: array of seconds
+    series: dict of arrays with the same length as timestamp, nans are ignored
+    dt: multiple of 10ms
+    return: resampled timestamp (seconds), dict of resampled series
+    '''
+    bin_ns = 10000000
+    step, rem = divmod(int(round(dt*1e9)), bin_ns)
+    assert rem == 0 and step > 0, "dt has to be a multiple of 10ms"
+
+    # same float -> ns conversion as pd.to_timedelta
+    timestamp = np.asarray(timestamp, dtype=np.float64)
+    base = timestamp.astype(np.int64)
+    ns = base*1000000000 + (np.round(timestamp-base, 9)*1e9).astype(np.int64)
+
+    start = ns.min()
+    bins = (ns-start) // bin_ns
+    num_bins = bins.max()+1
+    grid = np.arange(0, num_bins, step) # bins that are kept
+
+    resampled = {}
+    for key, val in series.items():
+        val = np.asarray(val, dtype=np.float64)
+        valid = ~np.isnan(val)
+        counts = np.bincount(bins[valid], minlength=num_bins)
+        sums = np.bincount(bins[valid], weights=val[valid], minlength=num_bins)
+        filled = np.flatnonzero(counts)
+        if len(filled) == 0:
+            resampled[key] = np.full(len(grid), np.nan)
+            continue
+        means = sums[filled]/counts[filled]
+        out = np.interp(grid, filled, means)
+        out[grid < filled[0]] = np.nan
+        resampled[key] = out
+
+    return (start + grid*bin_ns)*1e-9, resampled
+
+
 def add_filter(traj, raw, residual_threshold_x, residual_threshold_y, 
                conf_threshold, remain_threshold):
     '''
@@ -490,3 +539,134 @@ class SortedDLL:
     
 
       
+    
+
+
+class IndexedHeap:
+    '''
+    Drop-in replacement of SortedDLL (append, update, delete, first_node, count)
+    backed by a binary heap with the position of each node kept on the node,
+    so that every operation is O(log n) instead of walking the list
+    nodes are ordered by tail_time, ties are broken by the order in which tail_time is set (same as SortedDLL)
+    '''
+    def __init__(self, attr = "id"):
+        self.heap = []
+        self.cache = {} # key: fragment_id, val: Node with that fragment in it
+        self.attr = attr
+        self.seq = 0
+        
+    def count(self):
+        return len(self.cache)
+    
+    def first_node(self):
+        if not self.heap:
+            return None
+        return self.heap[0]
+    
+    def append(self, node):
+        if not isinstance(node, Node):
+            node = Node(node)
+        self.cache[getattr(node, self.attr)] = node
+        self.seq += 1
+        node.seq = self.seq
+        node.pos = len(self.heap)
+        self.heap.append(node)
+        self._sift_up(node.pos)
+    
+    def delete(self, node):
+        if not isinstance(node, Node):
+            node = self.cache.get(node)
+            if node is None:
+                # no id's available in cache
+                return None
+        self.cache.pop(getattr(node, self.attr))
+        last = self.heap.pop()
+        if last is not node:
+            # move the last node into the hole
+            self.heap[node.pos] = last
+            last.pos = node.pos
+            self._sift_up(last.pos)
+            self._sift_down(last.pos)
+        return node
+    
+    def update(self, key, attr_val, attr_name = "tail_time"):
+        if key not in self.cache:
+            print("key doesn't exists in update() IndexedHeap")
+            return
+        node = self.cache[key]
+        setattr(node, attr_name, attr_val)
+        self.seq += 1
+        node.seq = self.seq
+        self._sift_up(node.pos)
+        self._sift_down(node.pos)
+        
+    def get_attr(self, attr_name="tail_time"):
+        nodes = sorted(self.heap, key=lambda node: (node.tail_time, node.seq))
+        if attr_name == "self":
+            return nodes
+        return [getattr(node, attr_name) for node in nodes]
+    
+    def _sift_up(self, i):
+        heap = self.heap
+        node = heap[i]
+        key = (node.tail_time, node.seq)
+        while i > 0:
+            parent = (i-1) >> 1
+            if (heap[parent].tail_time, heap[parent].seq) <= key:
+                break
+            heap[i] = heap[parent]
+            heap[i].pos = i
+            i = parent
+        heap[i] = node
+        node.pos = i
+        
+    def _sift_down(self, i):
+        heap = self.heap
+        n = len(heap)
+        node = heap[i]
+        key = (node.tail_time, node.seq)
+        while True:
+            child = 2*i+1
+            if child >= n:
+                break
+            if child+1 < n and (heap[child+1].tail_time, heap[child+1].seq) < (heap[child].tail_time, heap[child].seq):
+                child += 1
+            if key <= (heap[child].tail_time, heap[child].seq):
+                break
+            heap[i] = heap[child]
+            heap[i].pos = i
+            i = child
+        heap[i] = node
+        node.pos = i
+        
+    def __repr__(self):
+        return "IndexedHeap({} nodes)".format(self.count())
+    
+    
+    
+if __name__ == '__main__':
+    # microbenchmark of SortedDLL vs IndexedHeap under a merger-like workload:
+    # n cached fragments, each step appends a new fragment, moves a few cached ones to the newest tail time (merges)
+    # and evicts the oldest one
+    import time
+    import random
+    
+    for n in [10000, 30000, 100000]:
+        for cls in [SortedDLL, IndexedHeap]:
+            random.seed(0)
+            cache = cls()
+            for i in range(n):
+                cache.append({"id": i, "tail_time": float(i)})
+            keys = list(range(n))
+            
+            steps = 200
+            t0 = time.time()
+            for step in range(steps):
+                curr = n + step
+                cache.append({"id": curr, "tail_time": float(curr)})
+                for key in random.sample(keys[-n//2:], 3):
+                    cache.update(key=key, attr_val=float(curr))
+                cache.delete(cache.first_node().id)
+                keys.append(curr)
+            elapsed = time.time()-t0
+            print("{:>12}  n={:>6}  {:.1f} us/step".format(cls.__name__, n, elapsed/steps*1e6))
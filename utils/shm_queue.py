@@ -0,0 +1,265 @@
+'''
+Queue between pipeline stages that moves the numeric arrays of fragments through a shared memory ring buffer
+only small descriptors (the other fields, pickled, and the offsets of the arrays in the ring) go through a
+multiprocessing.Queue pipe. a Manager queue pickles whole fragments and makes a round trip to the manager process
+on every put and get
+    - items are dicts, or lists/tuples of dicts (stitched trajectories, batches of reconciled trajectories).
+      their non-empty numeric numpy arrays are copied into the ring by put, and out of it by get, which frees the space
+    - items with less than min_bytes of arrays are pickled whole into the pipe, which is faster for small arrays.
+      so are items that do not fit in the free part of the ring, put never blocks
+    - any number of producers and consumers. every block in the ring starts with a header that get marks as
+      freed, the tail of the ring moves past freed blocks. blocks from several producers can arrive out of order,
+      their space is reused once all the blocks before them are freed, by whichever process frees the last one.
+      a restarted consumer picks up where the last one stopped
+    - like multiprocessing.Queue, the queue has to be made by the parent process and passed to the stages as
+      Process arguments. call unlink() once the pipeline is done
+same put/get/get_nowait/empty/qsize interface as the Manager queues
+'''
+import pickle
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+
+ALIGN = 64 # bytes, start of every block and of every array in the ring
+HEADER = ALIGN # bytes, in front of every block: freed flag, end of the block, bytes it takes up
+
+
+class _Ref(int):
+    '''
+    placeholder for the i-th array of an item
+    '''
+
+
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def _strip(obj, arrays):
+    '''
+    shallow copy of obj with its arrays replaced by _Ref, the arrays are appended to arrays
+    '''
+    if isinstance(obj, dict):
+        stripped = {}
+        for key, val in obj.items():
+            if isinstance(val, np.ndarray) and val.dtype.kind in "biuf" and val.nbytes > 0:
+                stripped[key] = _Ref(len(arrays))
+                arrays.append(val)
+            else:
+                stripped[key] = val
+        return stripped
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_strip(item, arrays) if isinstance(item, dict) else item for item in obj)
+    return obj
+
+
+def _restore(obj, arrays):
+    if isinstance(obj, dict):
+        return {key: arrays[val] if type(val) is _Ref else val for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_restore(item, arrays) if isinstance(item, dict) else item for item in obj)
+    return obj
+
+
+
+class ShmQueue:
+    '''
+    capacity: size of the ring in bytes, rounded down to ALIGN
+    min_bytes: items with fewer bytes of arrays are pickled into the pipe
+    '''
+    def __init__(self, capacity=32*2**20, min_bytes=2**16):
+        self.capacity = capacity // ALIGN * ALIGN
+        self.min_bytes = min_bytes
+        self._shm = shared_memory.SharedMemory(create=True, size=capacity)
+        self._ring = np.ndarray((capacity,), dtype=np.uint8, buffer=self._shm.buf)
+        self._queue = mp.Queue()
+        self._lock = mp.Lock()
+        self._head = mp.RawValue("q", 0) # next byte to allocate
+        self._tail = mp.RawValue("q", 0) # first byte in use
+        self._used = mp.RawValue("q", 0) # bytes in use, including headers and the skipped ends of the ring
+
+    def put(self, obj, block=True, timeout=None):
+        arrays = []
+        stripped = _strip(obj, arrays)
+        n = sum(_aligned(arr.nbytes) for arr in arrays)
+        allocated = self._allocate(n) if n >= self.min_bytes else None
+        if allocated is None:
+            self._queue.put((None, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)), block, timeout)
+            return
+
+        start, offset = allocated
+        specs = [] # (offset in the block, nbytes, dtype, shape)
+        pos = 0
+        for arr in arrays:
+            self._ring[offset+pos:offset+pos+arr.nbytes].view(arr.dtype).reshape(arr.shape)[...] = arr
+            specs.append((pos, arr.nbytes, arr.dtype.str, arr.shape))
+            pos += _aligned(arr.nbytes)
+        data = pickle.dumps((stripped, offset, n, specs), protocol=pickle.HIGHEST_PROTOCOL)
+        self._queue.put((start, data), block, timeout)
+
+    def get(self, block=True, timeout=None):
+        start, data = self._queue.get(block, timeout)
+        if start is None:
+            return pickle.loads(data)
+
+        stripped, offset, n, specs = pickle.loads(data)
+        arrays = self._ring[offset:offset+n].copy() # one copy for all the arrays of the item, then free the ring
+        self._release(start)
+        return _restore(stripped, [arrays[pos:pos+size].view(dtype).reshape(shape) for pos, size, dtype, shape in specs])
+
+    def put_nowait(self, obj):
+        return self.put(obj, False)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def empty(self):
+        return self._queue.empty()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def unlink(self):
+        '''
+        free the ring, the queue cannot be used afterwards
+        '''
+        self._queue.close()
+        del self._ring
+        self._shm.close()
+        self._shm.unlink()
+
+    def _allocate(self, n):
+        '''
+        reserve a header and n contiguous bytes of the ring, returns (start, offset) or None if they are not free
+        start: the header, offset: the n bytes. the header stays at start, the n bytes go to 0 if they do not fit
+        before the end of the ring, the skipped end is counted in the block's bytes
+        '''
+        if HEADER+n > self.capacity:
+            return None
+        with self._lock:
+            start = self._head.value
+            if start+HEADER+n <= self.capacity:
+                offset, nbytes = start+HEADER, HEADER+n
+            else:
+                offset, nbytes = 0, self.capacity-start+n
+            if self._used.value+nbytes > self.capacity:
+                return None
+            end = (offset+n) % self.capacity
+            self._header(start)[:] = (0, end, nbytes)
+            self._head.value = end
+            self._used.value += nbytes
+        return start, offset
+
+    def _release(self, start):
+        '''
+        mark the block at start as freed, then move the tail past all the freed blocks at the tail
+        '''
+        with self._lock:
+            self._header(start)[0] = 1
+            tail = self._tail.value
+            while self._used.value > 0:
+                freed, end, nbytes = self._header(tail)
+                if not freed:
+                    break
+                self._used.value -= int(nbytes)
+                tail = int(end)
+            self._tail.value = tail
+
+    def _header(self, start):
+        return self._ring[start:start+24].view(np.int64)
+
+    def __getstate__(self):
+        # only when processes are spawned, with fork the stages inherit the queue
+        state = dict(self.__dict__)
+        state["_shm"] = self._shm.name
+        del state["_ring"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = shared_memory.SharedMemory(name=state["_shm"])
+        self._ring = np.ndarray((self.capacity,), dtype=np.uint8, buffer=self._shm.buf)
+
+    def __repr__(self):
+        return 'ShmQueue({} MB, {} used)'.format(self.capacity >> 20, self._used.value)
+
+
+
+
+
+if __name__ == '__main__':
+    # python -m utils.shm_queue [n_fragments] [samples_per_fragment]
+    # move fragments from one process to another through a Manager queue, a multiprocessing.Queue and a ShmQueue
+    import sys
+    import time
+    import queue
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    fields = ["timestamp", "x_position", "y_position", "width", "length", "height", "velocity", "detection_confidence"]
+
+    def make_fragment(i):
+        fragment = {key: np.random.rand(length) for key in fields}
+        fragment.update({"_id": str(i), "direction": 1, "compute_node_id": 1, "first_timestamp": 0.0, "last_timestamp": 1.0,
+                         "starting_x": 0.0, "ending_x": 1.0, "flags": ["none"], "coarse_vehicle_class": 1})
+        return fragment
+
+    def produce(q, n):
+        fragment = make_fragment(0)
+        for i in range(n):
+            fragment["_id"] = str(i)
+            q.put(fragment)
+
+    def consume(q, n, out):
+        t0 = time.time()
+        for i in range(n):
+            fragment = q.get(timeout=60)
+            if i == 0:
+                t0 = time.time() # exclude the start of the producer
+        out.put(time.time()-t0)
+
+    # check that items come out as they went in, including ring wrap-around and the fallback when the ring is full
+    def same(a, b):
+        if isinstance(b, dict):
+            return a.keys() == b.keys() and all(np.array_equal(a[key], b[key]) for key in b)
+        return type(a) is type(b) and len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+
+    q = ShmQueue(capacity=2**16, min_bytes=0)
+    items = [make_fragment(i) for i in range(50)] + [[make_fragment(50), {"a": 1}], {"no_arrays": [1, 2]}, make_fragment(51)]
+    for item in items:
+        q.put(item)
+        assert same(q.get(timeout=1), item)
+    for item in items:
+        q.put(item)
+    assert all(same(q.get(timeout=1), item) for item in items)
+    assert q._used.value == 0
+    q.unlink()
+    print("round trip ok")
+
+    # blocks freed out of order, each by a process of its own, as after a consumer is restarted
+    q = ShmQueue(capacity=2**16, min_bytes=0)
+    for i in range(20): # wraps around the ring
+        blocks = [q._allocate(ALIGN*k) for k in (10, 20, 30)]
+        assert None not in blocks
+        for start, offset in blocks[::-1]:
+            proc = mp.Process(target=q._release, args=(start,))
+            proc.start()
+            proc.join()
+    assert q._used.value == 0 and q._tail.value == q._head.value
+    q.unlink()
+    print("out of order release ok")
+
+    nbytes = n*len(fields)*length*8
+    manager = mp.Manager()
+    for name, q in [("Manager().Queue", manager.Queue()), ("multiprocessing.Queue", mp.Queue()), ("ShmQueue", ShmQueue())]:
+        out = mp.Queue()
+        procs = [mp.Process(target=produce, args=(q, n)), mp.Process(target=consume, args=(q, n, out))]
+        for proc in procs:
+            proc.start()
+        elapsed = out.get()
+        for proc in procs:
+            proc.join()
+        print("{}: {} fragments of {} samples, {:.2f} sec, {:.0f} fragments/sec, {:.0f} MB/s".format(
+            name, n, length, elapsed, n/elapsed, nbytes/elapsed/2**20))
+        if isinstance(q, ShmQueue):
+            q.unlink()
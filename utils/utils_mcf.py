@@ -2,9 +2,10 @@ import numpy as np
 import networkx as nx
 import queue
 from collections import deque
-from utils.utils_stitcher_cost import stitch_cost, stitch_cost_simple_distance
+from utils.utils_stitcher_cost import stitch_cost, stitch_cost_batch, stitch_cost_simple_distance, kinematic_fits
 # from scipy import stats
 import itertools
+import heapq
 import _pickle as pickle
 
     
@@ -28,6 +29,54 @@ class Fragment():
         
 
 
+class TailIndex:
+    '''
+    end time and end x of the fragments in MOTGraphSingle.in_graph_deque, in the same order
+    used to find the fragments that a new fragment can be stitched to without calling stitch_cost on all of them
+    '''
+    def __init__(self, capacity = 1024):
+        self.t = np.empty(capacity)
+        self.x = np.empty(capacity)
+        self.start = 0 # position of in_graph_deque[0]
+        self.end = 0
+        
+    def __len__(self):
+        return self.end - self.start
+        
+    def append(self, t, x):
+        if self.end == len(self.t):
+            n = len(self)
+            if n > len(self.t) // 2:
+                self.t = np.concatenate([self.t, np.empty(len(self.t))])
+                self.x = np.concatenate([self.x, np.empty(len(self.x))])
+            self.t[:n] = self.t[self.start:self.end]
+            self.x[:n] = self.x[self.start:self.end]
+            self.start, self.end = 0, n
+        self.t[self.end] = t
+        self.x[self.end] = x
+        self.end += 1
+        
+    def popleft(self):
+        self.start += 1
+        
+    def candidates(self, t0, x0, direction, time_win, max_speed, slack):
+        '''
+        scan the fragments backwards from the newest, stop at the first one that ends more than time_win before t0
+        (same as scanning in_graph_deque), and keep those that end before t0 and from which x0 is reachable:
+            -slack <= direction * (x0 - x_end) <= max_speed * (t0 - t_end) + slack
+        nan positions are never pruned
+        return: indices in in_graph_deque of the kept fragments (newest first), number of fragments scanned
+        '''
+        gap = t0 - self.t[self.start:self.end]
+        too_old = np.flatnonzero(gap > time_win)
+        first = too_old[-1]+1 if len(too_old) else 0
+        gap = gap[first:]
+        dx = direction * (x0 - self.x[self.start+first:self.end])
+        keep = ~(gap < 0) & ~(dx < -slack) & ~(dx > max_speed * gap + slack)
+        return np.flatnonzero(keep)[::-1] + first, len(gap)
+        
+        
+
 class MOTGraphSingle:
     '''
     same as MOT_Graph except that every fragment is represented as a single node. this is equivalent to say that the inclusion cost for each fragment is 0, or the false positive rate is 0
@@ -45,6 +94,7 @@ class MOTGraphSingle:
         self.in_graph_deque = deque() # keep track of fragments that are currently in graph, ordered by last_timestamp
                         
         self.TIME_WIN = parameters["time_win"]
+        self.keep_win = self.TIME_WIN # fragments stay in in_graph_deque (stitch candidates) until keep_win after they end
         self.stitcher_mode = parameters["stitcher_mode"]
         self.param = parameters["stitcher_args"]
         if parameters["stitcher_mode"] == "master":
@@ -55,6 +105,12 @@ class MOTGraphSingle:
         self.compute_node_pos_map = {key:val for val,key in enumerate(parameters["compute_node_list"])}   
         self.cache = {}
         self.direction = direction
+        self.tail_index = TailIndex() # end time and x of the fragments in in_graph_deque
+        self.cost_evals = 0 # number of stitch_cost calls in add_node
+        self.cost_batch = parameters["stitch_cost_mode"] == "batch" # score all candidates of a fragment with one stitch_cost_batch call
+        self.cost_skipped = 0 # number of fragments within time_win that are not reachable, stitch_cost skipped
+        self.tail_heap = [] # (last_timestamp, insertion order, node) of path tails, entries of nodes that are no longer tails are skipped in pop_path
+        self.num_added = 0
           
     # @catch_critical(errors = (Exception))
     def add_node(self, fragment):
@@ -70,47 +126,23 @@ class MOTGraphSingle:
         self.G.add_edge("t", new_id, weight=0, match=True)
         self.G.nodes[new_id]["subpath"] = [new_id] # list of ids
         self.G.nodes[new_id]["last_timestamp"] = fragment["last_timestamp"]
+        self._push_tail(new_id, fragment["last_timestamp"])
         # self.G.nodes[new_id]["ending_x"] = fragment["ending_x"]
         # self.G.nodes[new_id]["filters"] = [fragment["filter"]] # list of lists
         self.cache[new_id] = fragment
-            
-        nc = len(self.in_graph_deque)
-        node_id = fragment["compute_node_id"]
         
-        if self.stitcher_mode == "local":
-            node_diff_thresh = 0
-        else:
-            node_diff_thresh = 1
-        for i in range(nc):
-            fgmt = self.in_graph_deque[nc-1-i]
-            # if timeout, no need to check for older fragments
-            gap = fragment["timestamp"][0] - fgmt["timestamp"][-1] 
-            if gap > self.param["time_win"]:
-                break
-                
-            fgmt_node_id = fgmt["compute_node_id"]
-            # print(str(fgmt["_id"])[-4:], fgmt_node_id)
-            
-            # stitch the same node_id in local mode
-            # if self.stitcher_mode == "local" and fgmt_node_id == node_id:
-            #     cost = stitch_cost(fgmt, fragment, self.TIME_WIN, self.param)
-
-            if abs(self.compute_node_pos_map[node_id]-self.compute_node_pos_map[fgmt_node_id]) <= node_diff_thresh:
-                cost = stitch_cost(fgmt, fragment, self.TIME_WIN, self.param)
-#                 print(str(fgmt["_id"])[-4:], str(fragment["_id"])[-4:], cost)
-            else:
-                cost = 1e5
-            
-            if cost <= self.param["stitch_thresh"]:  # new edge points from new_id to existing nodes, with postive cost
-                fgmt_id = fgmt[self.attr]
-                self.G.add_edge(new_id, fgmt_id, weight = self.param["stitch_thresh"]-cost, match = False)
+        for fgmt_id, weight in self.stitch_candidates(fragment):
+            if fgmt_id in self.G: # not popped yet, add_edge would re-add it as a node that can never be matched
+                self.G.add_edge(new_id, fgmt_id, weight = weight, match = False)
         
         # add Fragment pointer to cache
         self.in_graph_deque.append(fragment)
+        self.tail_index.append(fragment["timestamp"][-1], fragment["x_position"][-1])
 
         # check for time-out fragments in deque and compress paths
-        while self.in_graph_deque[0]["last_timestamp"] < fragment["first_timestamp"] - self.TIME_WIN:
+        while self.in_graph_deque[0]["last_timestamp"] < fragment["first_timestamp"] - self.keep_win:
             fgmt = self.in_graph_deque.popleft()
+            self.tail_index.popleft()
             fgmt_id = fgmt[self.attr]
             try:
                 for v,_,data in self.G.in_edges(fgmt_id, data = True):
@@ -127,6 +159,62 @@ class MOTGraphSingle:
                 pass
 
         
+    def stitch_candidates(self, fragment):
+        '''
+        score fragment against the fragments in in_graph_deque (newest first)
+        return: list of (fgmt_id, weight) for which cost <= stitch_thresh, weight = stitch_thresh - cost
+        '''
+        kinematic_fits(fragment) # head and tail fits for stitch_cost, computed once per fragment
+        node_id = fragment["compute_node_id"]
+        
+        if self.stitcher_mode == "local":
+            node_diff_thresh = 0
+        else:
+            node_diff_thresh = 1
+        # only fragments that are within time_win and kinematically reachable (by max_speed) are scored
+        candidates, scanned = self.tail_index.candidates(fragment["timestamp"][0], fragment["x_position"][0], fragment["direction"],
+                                                         self.param["time_win"], self.param["max_speed"], self.param["reach_slack"])
+        self.cost_skipped += scanned - len(candidates)
+        fgmts = [self.in_graph_deque[i] for i in candidates]
+        
+        if self.cost_batch:
+            # stitch the same node_id in local mode, neighboring nodes otherwise
+            fgmts = [fgmt for fgmt in fgmts 
+                     if abs(self.compute_node_pos_map[node_id]-self.compute_node_pos_map[fgmt["compute_node_id"]]) <= node_diff_thresh]
+            costs = stitch_cost_batch(fgmts, fragment, self.TIME_WIN, self.param)
+            self.cost_evals += len(fgmts)
+        else:
+            costs = []
+            for fgmt in fgmts:
+                fgmt_node_id = fgmt["compute_node_id"]
+                # print(str(fgmt["_id"])[-4:], fgmt_node_id)
+                
+                # stitch the same node_id in local mode
+                # if self.stitcher_mode == "local" and fgmt_node_id == node_id:
+                #     cost = stitch_cost(fgmt, fragment, self.TIME_WIN, self.param)
+    
+                if abs(self.compute_node_pos_map[node_id]-self.compute_node_pos_map[fgmt_node_id]) <= node_diff_thresh:
+                    cost = stitch_cost(fgmt, fragment, self.TIME_WIN, self.param)
+                    self.cost_evals += 1
+#                 print(str(fgmt["_id"])[-4:], str(fragment["_id"])[-4:], cost)
+                else:
+                    cost = 1e5
+                costs.append(cost)
+        
+        edges = []
+        for fgmt, cost in zip(fgmts, costs):
+            if cost <= self.param["stitch_thresh"]:  # new edge points from new_id to existing nodes, with postive cost
+                edges.append((fgmt[self.attr], self.param["stitch_thresh"]-cost))
+        return edges
+        
+    
+    def number_of_nodes(self):
+        return self.G.number_of_nodes()
+    
+    def number_of_edges(self):
+        return self.G.number_of_edges()
+        
+        
     # @catch_critical(errors = (Exception))
     def verify_path(self, path, cost_thresh = 10):
         # double check if any pair in path have conflict (large cost)
@@ -190,35 +278,47 @@ class MOTGraphSingle:
         '''
         construct an alternative matching tree (Hungarian tree) from root, alternate between unmatched edge and matched edge
         terminate until a node cannot change the longest distance of its outgoing neighbors
-        TODO: simultaneously build tree and keep track of the longest distance path from root to leaf, output that path
+        a BFS that stores the tree with parent pointers, the path to each node is only built for the best one
+        entry k of the tree is (node, parent entry, u), the path to entry k is path to parent + [u, node]
+        "t" is a sink: its edges all have weight 0 and every matched edge has weight >= 0, so it has no legal neighbors
         '''
-        q = queue.Queue()
-        q.put((root, [root], 0)) # keep track of current node, path from root, cost delta of the path
+        tree = [(root, -1, None)]
+        dist = [0] # cost delta of the path to each entry
+        q = deque([0])
         best_dist = -1
+        best = None # (entry, u) for the best path: path to entry (+ [u, "t"] if u is not None)
         explored = set()
-        best_path = None
-        steps = 0
         
-        while not q.empty():
-            x, path_to_x, dist_x = q.get()
+        while q:
+            k = q.popleft()
+            x = tree[k][0]
+            dist_x = dist[k]
             explored.add(x)
-            nei = self.find_legal_neighbors(x)
+            nei = [] if x == "t" else self.find_legal_neighbors(x)
             if not nei:
                 if dist_x > best_dist:
                     best_dist = dist_x
-                    best_path = path_to_x
+                    best = (k, None)
             for u, v, delta in nei:
                 if v == "t":
                     if dist_x + delta > best_dist:
                         best_dist = dist_x + delta
-                        best_path = path_to_x + [u, v]
+                        best = (k, u)
                 if u not in explored:
-                    q.put((v, path_to_x + [u, v], dist_x + delta))
-            steps +=1
-           
-#         try: pl = len(best_path)
-#         except: pl = 0
-        # print("alt path starting at {} | path length:{} | bfs steps:{}".format(root, pl, steps))           
+                    tree.append((v, k, u))
+                    dist.append(dist_x + delta)
+                    q.append(len(tree)-1)
+        
+        if best is None:
+            return None, best_dist
+        k, u = best
+        best_path = [] if u is None else ["t", u]
+        while k != -1:
+            x, k, u = tree[k]
+            best_path.append(x)
+            if u is not None:
+                best_path.append(u)
+        best_path.reverse()
         return best_path, best_dist
     
     
@@ -254,31 +354,35 @@ class MOTGraphSingle:
         return None  
     
     
+    def _push_tail(self, node, last_timestamp):
+        '''
+        node is a new path tail (matched edge from "t")
+        this only happens in add_node: alternating paths start at the new node and end at "t" at most, so augment_path can only
+        unmatch edges from "t", and a node that is no longer a tail never becomes one again
+        '''
+        heapq.heappush(self.tail_heap, (last_timestamp, self.num_added, node))
+        self.num_added += 1
+        
+    def _is_tail(self, node):
+        return node in self.G.adj["t"] and self.G["t"][node]["match"]
+    
+    def _collect_path(self, node):
+        '''
+        follow the matched edges from tail node, concatenate the subpaths
+        '''
+        path = []
+        while node is not None:
+            path.extend(self.G.nodes[node]["subpath"])
+            node = self.get_next_match(node)
+        return path
+    
     # @catch_critical(errors = (Exception))
     def get_all_traj(self):
         '''
         only called at final flushing
         traverse G along matched edges
         '''
-        self.all_paths = [] # list of lists [[id1, id2],[id3, id4]]
-        # self.all_filters = [] # list of lists of lists [[[1,1,0,0],[0,1,0]], [[0,0,1],[1,1]]]
-        
-        def dfs(node, path):
-            if not node: # at the leaf
-                self.all_paths.append(list(path))
-                
-                return list(path)
-            path = path + self.G.nodes[node]["subpath"]
-            next = self.get_next_match(node)
-            # print("curr: {},next: {}".format(node, next))
-            return dfs(next, path)
-            
-        tails =  self.G.adj["t"]
-        for tail in tails:
-            if self.G["t"][tail]["match"]:
-                one_path = dfs(tail, [])
-                # self.clean_graph([i for sublist in self.all_paths for i in sublist])
-                
+        self.all_paths = [self._collect_path(tail) for tail in self.G.adj["t"] if self.G["t"][tail]["match"]] # list of lists [[id1, id2],[id3, id4]]
         return self.all_paths
             
         
@@ -286,39 +390,16 @@ class MOTGraphSingle:
     def pop_path(self, time_thresh):
         '''
         examine tail and pop if timeout (last_timestamp < time_thresh)
-        remove the paths from G
-        return paths
+        only the tails in tail_heap that timed out are examined, paths are returned in the order the tails were added
+        return paths, the caller removes them with clean_graph
         '''
-        all_paths = [] # list of lists [[id1, id2],[id3, id4]]
-        # all_filters = [] # list of lists of lists [[[1,1,0,0],[0,1,0]], [[0,0,1],[1,1]]]
-        
-        def dfs(node, path):
-            if not node: # at the leaf
-                all_paths.append(list(path))
-                
-                return list(path)
-            
-            path = path + self.G.nodes[node]["subpath"]
-            next = self.get_next_match(node)
-            return dfs(next, path)
-            
-        tails =  self.G.adj["t"]
-        
-        for tail in tails:
-            if tail in self.G.nodes and self.G["t"][tail]["match"] \
-            and self.G.nodes[tail]["last_timestamp"] < time_thresh:
-#                 if (self.direction == "eb" and self.G.nodes[tail]["ending_x"] <= dist_thresh) \
-#                     or (self.direction == "wb" and self.G.nodes[tail]["ending_x"] > dist_thresh):
-                one_path = dfs(tail, [])
-                
-                # print("*** tail: ", tail, one_path)
-                # self.clean_graph(one_path)
-                
-        # 6/11/2023 remove isolated nodes in G TODO: not sure why they appear in the first place
-        self.G.remove_nodes_from(list(nx.isolates(self.G)))
-        
-                
-        return all_paths
+        tails = []
+        while self.tail_heap and self.tail_heap[0][0] < time_thresh:
+            _, order, tail = heapq.heappop(self.tail_heap)
+            if self._is_tail(tail):
+                tails.append((order, tail))
+        tails.sort()
+        return [self._collect_path(tail) for _, tail in tails]
         
     
     # @catch_critical(errors = (Exception))
@@ -342,10 +423,369 @@ class MOTGraphSingle:
             trajs.append(self.cache[_id])
         return trajs
             
+
+
+
+class ArrayNode:
+    '''
+    a node in MOTGraphArray
+    out: {successor: weight} for the edges to earlier fragments, in insertion order
+    ins: predecessors (later fragments that have an edge to this node)
+    prev: the node whose edge to this node is matched ("t" if this node is the tail of a path), None if not matched
+    next: the node this node has a matched edge to, None if this node is the head of a path
+    '''
+    __slots__ = ("key", "subpath", "last_timestamp", "out", "ins", "prev", "next")
+    
+    def __init__(self, key, last_timestamp):
+        self.key = key
+        self.subpath = [key]
+        self.last_timestamp = last_timestamp
+        self.out = {}
+        self.ins = set()
+        self.prev = "t"
+        self.next = None
+        
+
+
+class MOTGraphArray(MOTGraphSingle):
+    '''
+    same graph and algorithm as MOTGraphSingle, without networkx
+    nodes have integer ids and the matched edges are kept as prev/next pointers on the nodes, which is valid because
+    every node has exactly one matched incoming edge and at most one matched outgoing edge
+    the terminal is still called "t", its edges are the keys of t_out (every node in the graph, in insertion order)
+    '''
+    def __init__(self, direction=None, attr = "ID", parameters = None):
+        super().__init__(direction=direction, attr=attr, parameters=parameters)
+        self.G = None
+        self.nodes = {} # key: integer id, val: ArrayNode
+        self.ids = {} # key: fragment id, val: integer id
+        self.t_out = {} # integer ids of all nodes, ordered by insertion
+        self.num_edges = 0
+        self.next_id = 0
+        
+    def number_of_nodes(self):
+        return len(self.nodes)
+    
+    def number_of_edges(self):
+        return self.num_edges + len(self.t_out)
+    
+    def add_node(self, fragment):
+        new_id = fragment[self.attr]
+        i = self.next_id
+        self.next_id += 1
+        node = ArrayNode(new_id, fragment["last_timestamp"])
+        self.nodes[i] = node
+        self.ids[new_id] = i
+        self.t_out[i] = None
+        self._push_tail(i, fragment["last_timestamp"])
+        self.cache[new_id] = fragment
+        
+        for fgmt_id, weight in self.stitch_candidates(fragment):
+            j = self.ids.get(fgmt_id)
+            if j is None:
+                continue # already cleaned
+            node.out[j] = weight
+            self.nodes[j].ins.add(i)
+            self.num_edges += 1
+        
+        # add Fragment pointer to cache
+        self.in_graph_deque.append(fragment)
+        self.tail_index.append(fragment["timestamp"][-1], fragment["x_position"][-1])
+
+        # check for time-out fragments in deque and compress paths
+        while self.in_graph_deque[0]["last_timestamp"] < fragment["first_timestamp"] - self.keep_win:
+            fgmt = self.in_graph_deque.popleft()
+            self.tail_index.popleft()
+            j = self.ids.get(fgmt[self.attr])
+            if j is None:
+                continue
+            v = self.nodes[j].prev
+            if v is not None and v != "t":
+                # compress fgmt and v -> roll up subpath 
+                self.nodes[v].subpath.extend(self.nodes[j].subpath)
+                self._remove_node(j)
+    
+    def _remove_node(self, i):
+        node = self.nodes.pop(i)
+        del self.ids[node.key]
+        self.t_out.pop(i, None)
+        for u in node.out:
+            succ = self.nodes[u]
+            succ.ins.discard(i)
+            if succ.prev == i:
+                succ.prev = None
+        for v in node.ins:
+            pred = self.nodes[v]
+            del pred.out[i]
+            if pred.next == i:
+                pred.next = None
+        self.num_edges -= len(node.out) + len(node.ins)
+    
+    def clean_graph(self, path):
+        for key in path:
+            self.cache.pop(key, None)
+            i = self.ids.get(key)
+            if i is not None:
+                self._remove_node(i)
+    
+    def weight(self, v, u):
+        if v == "t":
+            return 0
+        return self.nodes[v].out[u]
+    
+    def find_legal_neighbors(self, node):
+        '''
+        same as MOTGraphSingle.find_legal_neighbors, with integer ids
+        "t" has no legal neighbors: its edges all have weight 0 and every matched edge has weight >= 0
+        '''
+        if node == "t":
+            return []
+        x = self.nodes[node]
+        nei = []
+        for u, cost_p in x.out.items():
+            if x.next != u:
+                v = self.nodes[u].prev
+                if v is not None:
+                    delta = cost_p - self.weight(v, u)
+                    if delta > 0:
+                        nei.append([u, v, delta])
+        return nei
+    
+    def augment_path(self, node):
+        '''
+        node: fragment id, already added to the graph
+        '''
+        alt_path, cost = self.find_alternating_path(self.ids[node])
+        
+        if alt_path is None: 
+            print("** alt_path for {} is None".format(node))
+            return
+        
+        forward = True
+        for i in range(len(alt_path)-1):
+            if forward: # match alt_path[i] -> alt_path[i+1]
+                v, u = alt_path[i], alt_path[i+1]
+                self.nodes[u].prev = v
+                if v != "t":
+                    self.nodes[v].next = u
+            else: # unmatch alt_path[i+1] -> alt_path[i]
+                v, u = alt_path[i+1], alt_path[i]
+                if self.nodes[u].prev == v:
+                    self.nodes[u].prev = None
+                if v != "t" and self.nodes[v].next == u:
+                    self.nodes[v].next = None
+            forward = not forward
+    
+    def get_next_match(self, node):
+        return self.nodes[self.ids[node]].next
+    
+    def _is_tail(self, i):
+        return i in self.nodes and self.nodes[i].prev == "t"
+    
+    def _collect_path(self, i):
+        path = []
+        while i is not None:
+            node = self.nodes[i]
+            path.extend(node.subpath)
+            i = node.next
+        return path
+    
+    def get_all_traj(self):
+        '''
+        only called at final flushing
+        traverse the graph along matched edges
+        '''
+        self.all_paths = [self._collect_path(i) for i in self.t_out if self.nodes[i].prev == "t"]
+        return self.all_paths
+    
+    def get_filters(self, path):
+        return []
        
         
        
+class MOTGraphOffline(MOTGraphSingle):
+    '''
+    batch version of the stitching graph for reprocessing a fixed set of fragments (stitcher_mode "offline")
+    add_node only collects the edges (same stitch_candidates as the online graphs), solve then finds the globally optimal matching:
+    every fragment has at most one matched edge to an earlier and at most one from a later fragment, maximize the total weight
+    this is a min-cost-flow on the bipartite graph (out-copy of the new fragment -> in-copy of the earlier one), solved with
+    network simplex for each connected component separately
+    '''
+    def __init__(self, direction=None, attr = "ID", parameters = None):
+        super().__init__(direction=direction, attr=attr, parameters=parameters)
+        self.G = None
+        self.edges = {} # key: fragment id, val: {earlier fragment id: weight}
+        self.num_edges = 0
+        
+    def number_of_nodes(self):
+        return len(self.edges)
+    
+    def number_of_edges(self):
+        return self.num_edges
+    
+    def add_node(self, fragment):
+        new_id = fragment[self.attr]
+        self.cache[new_id] = fragment
+        self.edges[new_id] = dict(self.stitch_candidates(fragment))
+        self.num_edges += len(self.edges[new_id])
+        
+        self.in_graph_deque.append(fragment)
+        self.tail_index.append(fragment["timestamp"][-1], fragment["x_position"][-1])
+        while self.in_graph_deque[0]["last_timestamp"] < fragment["first_timestamp"] - self.keep_win:
+            self.in_graph_deque.popleft()
+            self.tail_index.popleft()
+            
+    def path_weight(self, path):
+        '''
+        total weight of the matched edges in path (ordered from the last fragment to the first, as returned by pop_path)
+        '''
+        return sum(self.edges[path[k]][path[k+1]] for k in range(len(path)-1))
+    
+    def solve(self, scale = 1e6):
+        '''
+        weights are scaled by scale and rounded to integers for network simplex
+        return: paths (each ordered from the last fragment to the first, as pop_path), objective (total weight of the matched edges)
+        '''
+        U = nx.Graph()
+        U.add_nodes_from(self.edges)
+        U.add_edges_from((i, j) for i in self.edges for j in self.edges[i])
+        
+        next_match = {} # key: fragment id, val: the earlier fragment it is stitched to
+        for comp in nx.connected_components(U):
+            if len(comp) == 1:
+                continue
+            n = len(comp)
+            F = nx.DiGraph()
+            F.add_node("s", demand = -n)
+            F.add_node("t", demand = n)
+            F.add_edge("s", "t", capacity = n, weight = 0) # unmatched
+            for i in comp:
+                F.add_edge("s", ("out", i), capacity = 1, weight = 0)
+                F.add_edge(("in", i), "t", capacity = 1, weight = 0)
+                for j, weight in self.edges[i].items():
+                    F.add_edge(("out", i), ("in", j), capacity = 1, weight = -int(round(weight * scale)))
+            _, flow = nx.network_simplex(F)
+            for i in comp:
+                for (_, j), f in flow[("out", i)].items():
+                    if f > 0:
+                        next_match[i] = j
+        
+        matched = set(next_match.values())
+        paths = []
+        for i in self.cache: # in arrival order
+            if i not in matched: # the last fragment of a path
+                path = [i]
+                while path[-1] in next_match:
+                    path.append(next_match[path[-1]])
+                paths.append(path)
+        return paths, sum(self.edges[i][j] for i, j in next_match.items())
+        
+        
+        
+def synthetic_window(graph_class, window = 100, degree = 10, seed = 0):
+    '''
+    build a graph_class stitching graph on synthetic fragments, without stitch_cost
+    fragment i ends at time i, and gets edges to degree random fragments among the previous window ones with random weights
+    paths that ended more than 2*window ago are popped, as in min_cost_flow
+    return the graph and a function that adds the next fragment (returns its id), to add_node and augment_path by hand
+    '''
+    rng = np.random.default_rng(seed)
+    parameters = {"time_win": window, "stitcher_mode": "local", "stitch_cost_mode": "single", "compute_node_list": [], "stitcher_args": {}}
+    
+    class SyntheticGraph(graph_class):
+        def stitch_candidates(self, fragment):
+            i = fragment["ID"]
+            prev = rng.choice(np.arange(max(0, i-window), i), size = min(degree, i), replace = False) if i else []
+            return [(int(j), float(rng.uniform(0, 3))) for j in prev]
+    
+    m = SyntheticGraph(direction = 1, attr = "ID", parameters = parameters)
+    count = itertools.count()
+    def add():
+        i = next(count)
+        for path in m.pop_path(i - 2*window):
+            m.clean_graph(path)
+        m.add_node({"ID": i, "first_timestamp": i-0.5, "last_timestamp": i, "timestamp": [i-0.5, i], "x_position": [0, 0]})
+        return i
+    return m, add
+
+
+def queue_alternating_path(m, root):
+    '''
+    the previous queue.Queue version of find_alternating_path on graph m, it copies the path for every queue entry
+    only used as a reference for the benchmark below
+    '''
+    q = queue.Queue()
+    q.put((root, [root], 0)) # keep track of current node, path from root, cost delta of the path
+    best_dist = -1
+    explored = set()
+    best_path = None
+    
+    while not q.empty():
+        x, path_to_x, dist_x = q.get()
+        explored.add(x)
+        nei = m.find_legal_neighbors(x)
+        if not nei:
+            if dist_x > best_dist:
+                best_dist = dist_x
+                best_path = path_to_x
+        for u, v, delta in nei:
+            if v == "t":
+                if dist_x + delta > best_dist:
+                    best_dist = dist_x + delta
+                    best_path = path_to_x + [u, v]
+            if u not in explored:
+                q.put((v, path_to_x + [u, v], dist_x + delta))
+    return best_path, best_dist
+       
         
        
 if __name__ == '__main__':
-    print("not implemented")
+    # benchmark find_alternating_path against queue_alternating_path on synthetic dense windows
+    # python -m utils.utils_mcf
+    import time
+    import tracemalloc
+    
+    for graph_class in [MOTGraphSingle, MOTGraphArray]:
+        for window, degree in [(50, 5), (100, 10), (200, 20)]:
+            m, add = synthetic_window(graph_class, window = window, degree = degree)
+            root = (lambda i: m.ids[i]) if graph_class is MOTGraphArray else (lambda i: i)
+            find_legal_neighbors = m.find_legal_neighbors
+            steps = 0
+            def counted(node):
+                global steps
+                steps += 1
+                return find_legal_neighbors(node)
+            
+            elapsed = {"new": 0, "old": 0}
+            peak = {"new": 0, "old": 0}
+            tracemalloc.start()
+            for _ in range(1000):
+                i = add()
+                for name, search in [("new", m.find_alternating_path), ("old", lambda root: queue_alternating_path(m, root))]:
+                    if name == "old":
+                        m.find_legal_neighbors = counted
+                    tracemalloc.reset_peak()
+                    base = tracemalloc.get_traced_memory()[0]
+                    result = search(root(i))
+                    peak[name] = max(peak[name], tracemalloc.get_traced_memory()[1] - base)
+                    m.find_legal_neighbors = find_legal_neighbors
+                    if name == "new":
+                        path = result
+                    else:
+                        assert result == path, "find_alternating_path does not agree with queue_alternating_path"
+                m.augment_path(i)
+            tracemalloc.stop()
+            
+            # timing without tracemalloc, on a fresh graph with the same random edges
+            m, add = synthetic_window(graph_class, window = window, degree = degree)
+            for _ in range(1000):
+                i = add()
+                for name, search in [("new", m.find_alternating_path), ("old", lambda root: queue_alternating_path(m, root))]:
+                    t0 = time.perf_counter()
+                    search(root(i))
+                    elapsed[name] += time.perf_counter() - t0
+                m.augment_path(i)
+                
+            print("{} window={} degree={}: {} search steps".format(graph_class.__name__, window, degree, steps))
+            for name in ["old", "new"]:
+                print("    {}: {:.0f} steps/sec, peak memory per search {:.1f} KB".format(name, steps/elapsed[name], peak[name]/1024))
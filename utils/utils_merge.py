@@ -0,0 +1,223 @@
+import heapq
+import networkx as nx
+import numpy as np
+
+from utils.misc import IndexedHeap
+
+
+
+class IntervalIndex:
+    '''
+    index of fragments by their time range [t0, t1] and x range [x0, x1]
+    query returns the ids whose ranges overlap the query ranges, in insertion order
+    backed by append-only arrays with lazy deletion, compacted when more than half of the slots are dead
+    '''
+    def __init__(self, capacity = 1024):
+        self.ids = []
+        self.pos = {} # key: id, val: slot in the arrays
+        self.bounds = np.empty((capacity, 4)) # t0, t1, x0, x1
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.size = 0 # number of used slots (alive or dead)
+
+    def count(self):
+        return len(self.pos)
+
+    def insert(self, key, t0, t1, x0, x1):
+        if self.size == len(self.alive):
+            self._grow()
+        self.bounds[self.size] = (t0, t1, x0, x1)
+        self.alive[self.size] = True
+        self.pos[key] = self.size
+        self.ids.append(key)
+        self.size += 1
+
+    def remove(self, key):
+        i = self.pos.pop(key, None)
+        if i is None:
+            return
+        self.alive[i] = False
+        if len(self.pos) < self.size // 2:
+            self._compact()
+
+    def query(self, t0, t1, x0, x1):
+        '''
+        return ids with t1' > t0 and t0' < t1 (time overlap) and x1' >= x0 and x0' <= x1 (space overlap)
+        bounds that are nan never prune a fragment
+        '''
+        b = self.bounds[:self.size]
+        mask = self.alive[:self.size] & ~(b[:,1] <= t0) & ~(t1 <= b[:,0]) & ~(b[:,2] > x1) & ~(x0 > b[:,3])
+        return [self.ids[i] for i in np.flatnonzero(mask)]
+
+    def _grow(self):
+        n = len(self.alive)
+        self.bounds = np.concatenate([self.bounds, np.empty((n, 4))])
+        self.alive = np.concatenate([self.alive, np.zeros(n, dtype=bool)])
+
+    def _compact(self):
+        keep = np.flatnonzero(self.alive[:self.size])
+        n = len(keep)
+        self.bounds[:n] = self.bounds[keep]
+        self.alive[:n] = True
+        self.alive[n:] = False
+        self.ids = [self.ids[i] for i in keep]
+        self.pos = {key: i for i, key in enumerate(self.ids)}
+        self.size = n
+
+
+
+def merge_bounds(track):
+    '''
+    time and x range of a resampled fragment, as used by merge_cost to rule out pairs with no space-time overlap
+    the x range is extended by the vehicle length in the direction of travel
+    '''
+    t, x = track["timestamp"], track["x_position"]
+    sx, ex = min(x[0], x[-1]), max(x[0], x[-1])
+    l = np.nanmean(track["length"])
+    if track["direction"] == 1:
+        ex = ex + l
+    else:
+        sx = sx - l
+    return t[0], t[-1], sx, ex
+
+
+
+class NetworkxComponents:
+    '''
+    merge graph kept as a nx.Graph, two nodes are connected if they can be merged
+    the tail time of each node is kept in an IndexedHeap, a component is evicted once its earliest tail is out of the time window
+    '''
+    def __init__(self):
+        self.G = nx.Graph()
+        self.tails = IndexedHeap() # a data structure to ensure trajectories are ordered in last_timestamp
+
+    def number_of_nodes(self):
+        return self.G.number_of_nodes()
+
+    def number_of_edges(self):
+        return self.G.number_of_edges()
+
+    def data(self, key):
+        return self.G.nodes[key]["data"]
+
+    def add_node(self, key, data, tail_time):
+        self.tails.append({"id": key, "tail_time": tail_time})
+        self.G.add_node(key, data=data)
+
+    def add_edge(self, u, v, tail_time, weight=None):
+        self.G.add_edge(u, v, weight=weight)
+        self.tails.update(key=v, attr_val=tail_time)
+        self.tails.update(key=u, attr_val=tail_time)
+
+    def pop_expired(self, time_thresh):
+        '''
+        remove and return the components (lists of node data) whose earliest node tail is before time_thresh
+        '''
+        comps = []
+        to_remove = set()
+        # check if the first in lru is timed out
+        while True:
+            first = self.tails.first_node()
+            if first is None or first.tail_time >= time_thresh:
+                break # no need to check lru further
+            comp = nx.node_connected_component(self.G, first.id)
+            comps.append([self.G.nodes[v]["data"] for v in comp])
+            to_remove = to_remove.union(comp)
+            for v in comp:
+                self.tails.delete(v)
+        
+        self.G.remove_nodes_from(to_remove)
+        return comps
+
+    def pop_all(self):
+        comps = [[self.G.nodes[v]["data"] for v in comp] for comp in nx.connected_components(self.G)]
+        self.G.clear()
+        self.tails = IndexedHeap()
+        return comps
+
+
+
+class UnionFindComponents:
+    '''
+    same interface and eviction order as NetworkxComponents, without the graph:
+    only the component of each node is kept (union-find with path halving and union by size),
+    together with the tail time of each node in a heap with lazy deletion
+    ties in tail time are broken by the order in which the tails are set, same as SortedDLL
+    nodes in a component are listed in insertion order
+    '''
+    def __init__(self):
+        self.parent = {} # key: node id, val: parent node id
+        self.members = {} # key: root id, val: list of node ids in the component
+        self.edges = {} # key: root id, val: number of edges in the component
+        self.nodes = {} # key: node id, val: [insertion order, tail sequence number, data]
+        self.heap = [] # (tail_time, sequence number, node id), stale if the node is gone or has a newer sequence number
+        self.seq = 0
+
+    def number_of_nodes(self):
+        return len(self.nodes)
+
+    def number_of_edges(self):
+        return sum(self.edges.values())
+
+    def data(self, key):
+        return self.nodes[key][2]
+
+    def find(self, key):
+        parent = self.parent
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def add_node(self, key, data, tail_time):
+        self.parent[key] = key
+        self.members[key] = [key]
+        self.edges[key] = 0
+        self.nodes[key] = [self.seq, None, data]
+        self._set_tail(key, tail_time)
+
+    def add_edge(self, u, v, tail_time, weight=None):
+        ru, rv = self.find(u), self.find(v)
+        if ru != rv:
+            if len(self.members[ru]) < len(self.members[rv]):
+                ru, rv = rv, ru
+            self.parent[rv] = ru
+            self.members[ru].extend(self.members.pop(rv))
+            self.edges[ru] += self.edges.pop(rv)
+        self.edges[ru] += 1
+        self._set_tail(v, tail_time)
+        self._set_tail(u, tail_time)
+
+    def _set_tail(self, key, tail_time):
+        self.seq += 1
+        self.nodes[key][1] = self.seq
+        heapq.heappush(self.heap, (tail_time, self.seq, key))
+
+    def pop_expired(self, time_thresh):
+        '''
+        remove and return the components (lists of node data) whose earliest node tail is before time_thresh
+        '''
+        comps = []
+        heap = self.heap
+        while heap:
+            tail_time, seq, key = heap[0]
+            node = self.nodes.get(key)
+            if node is None or node[1] != seq:
+                heapq.heappop(heap) # stale
+                continue
+            if tail_time >= time_thresh:
+                break
+            comps.append(self._pop_component(self.find(key)))
+        return comps
+
+    def pop_all(self):
+        roots = sorted(self.members, key=lambda root: min(self.nodes[v][0] for v in self.members[root]))
+        comps = [self._pop_component(root) for root in roots]
+        self.heap = []
+        return comps
+
+    def _pop_component(self, root):
+        comp = sorted(self.members.pop(root), key=lambda v: self.nodes[v][0])
+        self.edges.pop(root)
+        for v in comp:
+            del self.parent[v]
+        return [self.nodes.pop(v)[2] for v in comp]
@@ -1,8 +1,12 @@
-import pandas as pd
 import numpy as np
+import time
 from cvxopt import matrix, solvers, sparse,spdiag,spmatrix
 from bson.objectid import ObjectId
-from collections import defaultdict
+from collections import defaultdict, Counter
+import itertools
+from functools import lru_cache
+from scipy.linalg import solveh_banded, cholesky_banded, cho_solve_banded
+from utils.misc import resample_uniform
 # from .misc import flattenList
 
 # TODO
@@ -23,6 +27,31 @@ def flattenList(nestedList):
     return nestedList[:1] + flattenList(nestedList[1:])
 
 
+def flatten_ids(nested):
+    '''
+    iterative version of flattenList: flatten arbitrarily nested lists into one list, in order
+    '''
+    flat = []
+    stack = [iter(nested)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, list):
+                stack.append(iter(item))
+                break
+            flat.append(item)
+        else:
+            stack.pop()
+    return flat
+
+
+def most_common(values):
+    '''
+    the most frequent element of values, same as max(set(values), key=values.count) (including ties) but counts in one pass
+    '''
+    counts = Counter(values)
+    return max(set(values), key=counts.__getitem__)
+
+
 def combine_fragments(all_fragment):
     '''
     stack fragments from stitched_doc to a single document
@@ -33,45 +62,29 @@ def combine_fragments(all_fragment):
     fields that need to be removed: _id, 
     fields that are preserved (copied from any fragment): vehicle class
     fields that need to be re-assigned: first_timestamp, last_timestamp, starting_x, ending_x, length, width, height
+    the time series are concatenated once as numpy arrays, length, width and height can be scalars or arrays per fragment
     '''
     
     stacked = defaultdict(list)
     
+    for key in ["timestamp", "x_position", "y_position"]:
+        stacked[key] = np.concatenate([np.asarray(fragment[key], dtype=float) for fragment in all_fragment])
+    stacked["flags"] = list(itertools.chain.from_iterable(fragment["flags"] for fragment in all_fragment))
+    
+    # take the median of dimensions
+    for key in ["length", "width", "height"]:
+        stacked[key] = np.median(np.concatenate([np.atleast_1d(np.asarray(fragment[key], dtype=float)) for fragment in all_fragment]))
+    
     for fragment in all_fragment:
-        # logger.debug("fragment keys: {}".format(fragment.keys()))
-        stacked["timestamp"].extend(fragment["timestamp"])
-        
-        stacked["x_position"].extend(fragment["x_position"])
-        stacked["y_position"].extend(fragment["y_position"])
-        stacked["flags"].extend(fragment["flags"])
-        
-        try:
-            stacked["length"].extend(fragment["length"])
-            stacked["width"].extend(fragment["width"])
-            stacked["height"].extend(fragment["height"])
-        except:
-            stacked["length"].append(fragment["length"])
-            stacked["width"].append(fragment["width"])
-            stacked["height"].append(fragment["height"])
         try: # other optional fields
             stacked["merged_ids"].append(fragment["merged_ids"]) # should be nested lists
             stacked["road_segment_ids"].extend(fragment["road_segment_ids"])
         except KeyError:
             pass
-        
-        # stacked["detection_confidence"].extend(fragment["detection_confidence"])
-        # if "fragment_ids" in fragment:
-        #     stacked["fragment_ids"].extend(fragment["fragment_ids"])
-        # else:
-        #     stacked["fragment_ids"].append(fragment["_id"])
-        stacked["fragment_ids"] = flattenList(stacked["merged_ids"])
-        
-        stacked["coarse_vehicle_class"].append(fragment["coarse_vehicle_class"])
-        stacked["fine_vehicle_class"].append(fragment["fine_vehicle_class"])
-        stacked["direction"].append(fragment["direction"])
-        stacked["compute_node_id"].append(fragment["compute_node_id"])
-        stacked["local_fragment_id"].append(fragment["local_fragment_id"])
+    stacked["fragment_ids"] = flatten_ids(stacked["merged_ids"])
     
+    for key in ["coarse_vehicle_class", "fine_vehicle_class", "direction", "compute_node_id", "local_fragment_id"]:
+        stacked[key] = [fragment[key] for fragment in all_fragment]
     
     # first_fragment = raw_collection.find_one({"_id": first_id})
     first_fragment = all_fragment[0]
@@ -88,20 +101,10 @@ def combine_fragments(all_fragment):
     stacked["ending_x"] = last_fragment["ending_x"]
     stacked["last_timestamp"] = last_fragment["last_timestamp"]
     
-    # take the median of dimensions
-    stacked["length"] = np.median(stacked["length"])
-    stacked["width"] = np.median(stacked["width"])
-    stacked["height"] = np.median(stacked["height"])
-    
     # Take the most frequent element of the list
-    stacked["coarse_vehicle_class"] = max(set(stacked["coarse_vehicle_class"]), key = stacked["coarse_vehicle_class"].count)
-    stacked["fine_vehicle_class"] = max(set(stacked["fine_vehicle_class"]), key = stacked["fine_vehicle_class"].count)
-    stacked["direction"] = max(set(stacked["direction"]), key = stacked["direction"].count)
-    
-    # Take the first
-    # -- flatten the list first 
-    # compute_node_id_list = flattenList(stacked["compute_node_id"])
-    # stacked["compute_node_id"] = max(stacked["compute_node_id"])
+    stacked["coarse_vehicle_class"] = most_common(stacked["coarse_vehicle_class"])
+    stacked["fine_vehicle_class"] = most_common(stacked["fine_vehicle_class"])
+    stacked["direction"] = most_common(stacked["direction"])
     
     # other parameters
     # stacked["compute_node_id"] = os.uname()[1]
@@ -121,49 +124,21 @@ def resample(car, dt=0.04, fillnan=False):
     time_series_field = ["timestamp", "x_position", "y_position"]
     data = {key: car[key] for key in time_series_field}
     
-    # Read to dataframe and resample
-    df = pd.DataFrame(data, columns=data.keys()) 
-    index = pd.to_timedelta(df["timestamp"], unit='s')
-    df = df.set_index(index)
-    df = df.drop(columns = "timestamp")
-    
-    freq = str(dt)+"S"
-#     df = df.resample(freq).mean() # leave nans
-#     if fillnan:
-#         df = df.interpolate(method='linear')
-#     df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
-
-    # resample to 25hz
-    # df=df.groupby(df.index.floor('0.04S')).mean().resample('0.04S').asfreq()
-    # df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
-    # df = df.interpolate(method='linear')
-    # df=df.groupby(df.index.floor('0.04S')).mean().resample('0.04S').asfreq() # resample to 25Hz snaps to the closest integer
-    
-    
-    
-    
     # resample to 100hz
     # to avoid the bias introduced by "floor" resample..., first upsample to 10ms, and then downsample to 25hz,
     # this method does not "snap" the timestamps to floor
-    df=df.resample('10L').mean().interpolate(method="linear").resample(freq).asfreq()
-    df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
-    # df=df.groupby(df.index.floor('0.04S')).mean().resample('0.04S').asfreq()
-
-
-
-    
-    
+    timestamp, resampled = resample_uniform(data.pop("timestamp"), data, dt=dt)
     
     # do not extrapolate for more than 1 sec
-    first_valid_time = pd.Series.first_valid_index(df['x_position'])
-    last_valid_time = pd.Series.last_valid_index(df['x_position'])
+    valid = np.flatnonzero(~np.isnan(resampled['x_position']))
+    first_valid_time, last_valid_time = timestamp[valid[0]], timestamp[valid[-1]]
     first_time = max(min(car['timestamp']), first_valid_time-1)
     last_time = min(max(car['timestamp']), last_valid_time+1)
-    df=df[first_time:last_time]
+    keep = (timestamp >= first_time) & (timestamp <= last_time)
     
-    car['x_position'] = df['x_position'].values
-    car['y_position'] = df['y_position'].values
-    car['timestamp'] = df.index.values
+    car['x_position'] = resampled['x_position'][keep]
+    car['y_position'] = resampled['y_position'][keep]
+    car['timestamp'] = timestamp[keep]
         
     return car
 
@@ -173,21 +148,29 @@ def resample(car, dt=0.04, fillnan=False):
 
 
 # ==================== CVX optimization for 2d dynamics ==================    
-def opt1(car, lam3_x, lam3_y):
+def opt1(car, lam3_x, lam3_y, solver_x="cvxopt", solver_y="cvxopt"):
     '''
     1/M||z-Hx||_2^2 + \\lam3/N ||D3x||_2^2
+    solver_x, solver_y: "cvxopt" or "banded" (smooth_banded) per axis
     '''
     x = car["x_position"]
     y = car["y_position"]
     # x
-    Q, p, H, N, M = _get_qp_opt1(x, lam3_x)
-    sol=solvers.qp(P=Q, q=p)
-    xhat = sol["x"][:N]
+    if solver_x == "banded":
+        xhat = smooth_banded(x, 0, lam3_x)
+    else:
+        Q, p, H, N, M = _get_qp_opt1(x, lam3_x)
+        sol=solvers.qp(P=Q, q=p)
+        xhat = sol["x"][:N]
     
     # y
-    Q, p, H, N, M = _get_qp_opt1(y, lam3_y)
-    sol=solvers.qp(P=Q, q=p)
-    yhat = sol["x"][:N]
+    if solver_y == "banded":
+        yhat = smooth_banded(y, 0, lam3_y)
+    else:
+        Q, p, H, N, M = _get_qp_opt1(y, lam3_y)
+        sol=solvers.qp(P=Q, q=p)
+        yhat = sol["x"][:N]
+    M = np.count_nonzero(~np.isnan(y))
     
     car["timestamp"] = list(car["timestamp"])
     car["x_position"] = list(xhat)
@@ -236,21 +219,29 @@ def opt1_l1(car, lam3_x, lam3_y, lam1_x, lam1_y):
     
     return car
 
-def opt2(car, lam2_x, lam2_y, lam3_x, lam3_y):
+def opt2(car, lam2_x, lam2_y, lam3_x, lam3_y, solver_x="cvxopt", solver_y="cvxopt"):
     '''
     1/M||z-Hx||_2^2 + \\lam2/N ||D2x||_2^2 + \\lam3/N ||D3x||_2^2
+    solver_x, solver_y: "cvxopt" or "banded" (smooth_banded) per axis
     '''
     x = car["x_position"]
     y = car["y_position"]
     # x
-    Q, p, H, N, M = _get_qp_opt2(x, lam2_x, lam3_x)
-    sol=solvers.qp(P=Q, q=p)
-    xhat = sol["x"][:N]
+    if solver_x == "banded":
+        xhat = smooth_banded(x, lam2_x, lam3_x)
+    else:
+        Q, p, H, N, M = _get_qp_opt2(x, lam2_x, lam3_x)
+        sol=solvers.qp(P=Q, q=p)
+        xhat = sol["x"][:N]
     
     # y
-    Q, p, H, N, M = _get_qp_opt2(y, lam2_y, lam3_y)
-    sol=solvers.qp(P=Q, q=p)
-    yhat = sol["x"][:N]
+    if solver_y == "banded":
+        yhat = smooth_banded(y, lam2_y, lam3_y)
+    else:
+        Q, p, H, N, M = _get_qp_opt2(y, lam2_y, lam3_y)
+        sol=solvers.qp(P=Q, q=p)
+        yhat = sol["x"][:N]
+    M = np.count_nonzero(~np.isnan(y))
     
     car["timestamp"] = list(car["timestamp"])
     car["x_position"] = list(xhat)
@@ -292,7 +283,7 @@ def opt2_l1(car, lam2_x, lam2_y, lam3_x, lam3_y, lam1_x, lam1_y):
         Q, p, H, G, h, N, M, D2 = _get_qp_opt2_l1(x, lam2_x, lam3_x, lam1_x)
         sol=solvers.qp(P=Q, q=matrix(p) , G=G, h=matrix(h))
         xhat = sol["x"][:N]
-        D1 = _blocdiag(matrix([-1,1],(1,2), tc="d"), N) * (1/dt)
+        D1 = _diff_ops(N)[0]
         vx = D1*xhat*dir
         minvx = min(vx)
         print("minvx ", minvx)
@@ -363,10 +354,17 @@ def opt2_l1(car, lam2_x, lam2_y, lam3_x, lam3_y, lam1_x, lam1_y):
     return car 
 
 
-def opt2_l1_constr(car, lam2_x, lam2_y, lam3_x, lam3_y, lam1_x, lam1_y):
+def opt2_l1_constr(car, lam2_x, lam2_y, lam3_x, lam3_y, lam1_x, lam1_y, lam1_rtol=0, warm_start=True, solver_y="cvxopt",
+                   ph=None, ih=None):
     '''
     1/M||z-Hx||_2^2 + \\lam2/N ||D2x||_2^2 + \\lam3/N ||D3x||_2^2 + \\lam1/M ||e||_1
     s.t. D1x >=0, -10<=D2x<=10, -3 <=D3x<=3
+    lam1_x is increased until the MAE in x improves by less than lam1_rtol (relative), each solve is warm-started
+    from the previous solution if warm_start
+    the number of QP solves and interior-point iterations in x and the total solve time are recorded in car["reconciliation_stats"]
+    y is unconstrained, solver_y="banded" solves it with smooth_banded instead of cvxopt
+    ph, ih: prediction and implementation horizon in sec. if given and the trajectory is longer than ph, x is solved
+    in receding horizon windows (see _receding_horizon_x)
     '''
     x = car["x_position"]
     y = car["y_position"]
@@ -374,21 +372,17 @@ def opt2_l1_constr(car, lam2_x, lam2_y, lam3_x, lam3_y, lam1_x, lam1_y):
     x = x-xmin
     
     # x
-    max_iter = 10
     dir = car["direction"]
-    
-    cx_pre = 999
-    cx = cx_pre-1
-    iter = 0
-    while cx - cx_pre < 0 and iter <= max_iter:
-        # print("iter, ", cx)
-        lam1_x += 1e-3
-        Q, p, H, G, h, N, M, D1,D2,D3 = _get_qp_opt2_l1_constr(x, dir, lam2_x, lam3_x, lam1_x)
-        sol=solvers.qp(P=Q, q=matrix(p) , G=G, h=matrix(h))
-        xhat = sol["x"][:N]
-        cx_pre = cx
-        cx = np.nansum(np.abs(H*matrix(x)-H*xhat))/M
-        iter += 1
+    start = time.time()
+    N = len(x)
+    PH = int(round(ph/(car["timestamp"][1]-car["timestamp"][0]))) if ph is not None and N > 1 else N
+    if PH < N:
+        IH = int(round(ih/(car["timestamp"][1]-car["timestamp"][0])))
+        xhat, stats = _receding_horizon_x(x, dir, PH, IH, lam2_x, lam3_x, lam1_x, lam1_rtol, warm_start)
+    else:
+        xhat, stats = _opt2_l1_constr_x(x, dir, lam2_x, lam3_x, lam1_x, lam1_rtol, warm_start)
+    H, _ = _observation_ops([i.item() for i in np.flatnonzero(~np.isnan(x))], N)
+    M = H.size[0]
     
     # vmin = min(abs(D1*xhat))
     # amax = max(abs(D2*xhat))
@@ -402,9 +396,12 @@ def opt2_l1_constr(car, lam2_x, lam2_y, lam3_x, lam3_y, lam1_x, lam1_y):
     # print(f"lam2_x {lam2_x}, lam2_y {lam2_y}, lam3_x {lam3_x}, lam3_y {lam3_y},lam1_x {lam1_x}, lam1_y {lam1_y}")
     # print(sol["status"])
     # y
-    Q, p, H, G, h, N, M, D2 = _get_qp_opt2_l1(y, lam2_y, lam3_y, lam1_y)
-    sol=solvers.qp(P=Q, q=matrix(p) , G=G, h=matrix(h))
-    yhat = sol["x"][:N]
+    if solver_y == "banded":
+        yhat = smooth_banded(y, lam2_y, lam3_y, lam1_y)
+    else:
+        Q, p, H, G, h, N, M, D2 = _get_qp_opt2_l1(y, lam2_y, lam3_y, lam1_y)
+        sol=solvers.qp(P=Q, q=matrix(p) , G=G, h=matrix(h))
+        yhat = sol["x"][:N]
     # if sol["status"]!= "optimal":
     #     raise Exception("solver status is not optimal")
     # print("y: ",sol["status"])
@@ -427,10 +424,82 @@ def opt2_l1_constr(car, lam2_x, lam2_y, lam3_x, lam3_y, lam1_x, lam1_y):
     
     car["x_score"] = cx
     car["y_score"] = cy
+    stats["solve_time"] = time.time()-start
+    car["reconciliation_stats"] = stats
     
     return car 
 
 
+def _opt2_l1_constr_x(x, dir, lam2, lam3, lam1, lam1_rtol=0, warm_start=True, x_fixed=None):
+    '''
+    x part of opt2_l1_constr, with the lam1 continuation
+    x_fixed: if given, the first len(x_fixed) entries of xhat are constrained to x_fixed
+    returns xhat as a (N,1) cvxopt matrix, and the number of QP solves and interior-point iterations
+    '''
+    max_iter = 10
+    cx_pre = np.inf
+    cx = 999
+    iter = 0
+    qp_iterations = 0
+    initvals = None
+    # Q, G, h do not depend on lam1, only p is updated in the loop
+    Q, p, H, G, h, N, M, D1,D2,D3 = _get_qp_opt2_l1_constr(x, dir, lam2, lam3, lam1)
+    h = matrix(h)
+    A, b = None, None
+    if x_fixed is not None:
+        k = len(x_fixed)
+        A = spmatrix(1.0, range(k), range(k), (k, Q.size[0]))
+        b = matrix(np.asarray(x_fixed, dtype=float))
+    x_obs = x[~np.isnan(x)]
+    while cx < cx_pre * (1-lam1_rtol) and iter <= max_iter:
+        # print("iter, ", cx)
+        lam1 += 1e-3
+        p = _get_p_l1(x_obs, H, M, lam1)
+        sol=solvers.qp(P=Q, q=matrix(p) , G=G, h=h, A=A, b=b, initvals=initvals)
+        qp_iterations += sol["iterations"]
+        if warm_start:
+            initvals = _warm_start(sol)
+        xhat = sol["x"][:N]
+        cx_pre = cx
+        cx = np.nansum(np.abs(H*matrix(x)-H*xhat))/M
+        iter += 1
+    
+    return xhat, {"x_solves": iter, "x_iterations": qp_iterations, "windows": 1}
+
+
+def _receding_horizon_x(x, dir, PH, IH, lam2, lam3, lam1, lam1_rtol=0, warm_start=True):
+    '''
+    solve the x part of opt2_l1_constr in overlapping windows of PH samples, keeping the first IH solved samples
+    of each window. every window after the first starts 3 samples before the kept part and fixes them to the kept
+    solution, so that the velocity, acceleration and jerk constraints hold across the window boundaries
+    each window is shifted to its own minimum to keep the numeral ranges small
+    returns xhat as a (N,1) cvxopt matrix and the summed solver stats
+    '''
+    if PH < IH+4:
+        raise ValueError("prediction horizon has to be at least 4 samples longer than the implementation horizon")
+    N = len(x)
+    xhat = np.empty(N)
+    stats = {"x_solves": 0, "x_iterations": 0, "windows": 0}
+    start, k = 0, 0 # the first k samples of the window are fixed
+    while True:
+        end = min(start+PH, N)
+        offset = np.nanmin(x[start:end])
+        x_fixed = xhat[start:start+k]-offset if k else None
+        xhat_w, stats_w = _opt2_l1_constr_x(x[start:end]-offset, dir, lam2, lam3, lam1, lam1_rtol, warm_start, x_fixed)
+        xhat_w = np.reshape(xhat_w, -1)+offset
+        stats["x_solves"] += stats_w["x_solves"]
+        stats["x_iterations"] += stats_w["x_iterations"]
+        stats["windows"] += stats_w["windows"]
+        if end == N:
+            xhat[start:] = xhat_w
+            break
+        keep = k+IH
+        xhat[start:start+keep] = xhat_w[:keep]
+        start, k = start+keep-3, 3
+    
+    return matrix(xhat), stats
+
+
 
 
 
@@ -454,14 +523,11 @@ def _get_qp_opt1(x, lam3):
         raise ZeroDivisionError
         
     # differentiation operator
-    D3 = _blocdiag(matrix([-1,3,-3,1],(1,4), tc="d"), N) * (1/dt**3)
+    D1, D2, D3, DD2, DD3 = _diff_ops(N)
     
-    DD = lam3 * D3.trans() * D3
+    DD = lam3 * DD3
     # sol: xhat = (I+delta D'D)^(-1)x
-    I = spmatrix(1.0, range(N), range(N))
-    H = I[idx,:]
-    DD = lam3 * D3.trans() * D3
-    HH = H.trans() * H
+    H, HH = _observation_ops(idx, N)
 
     Q = 2*(HH/M+DD/(N-3))
     p = -2*H.trans() * matrix(x)/M
@@ -486,25 +552,21 @@ def _get_qp_opt1_l1(x, lam3, lam1):
     if M == 0 or N-3 <= 0:
         raise ZeroDivisionError
     # differentiation operator
-    # D1 = _blocdiag(matrix([-1,1],(1,2), tc="d"), N) * (1/dt)
-    # D2 = _blocdiag(matrix([1,-2,1],(1,3), tc="d"), N) * (1/dt**2)
-    D3 = _blocdiag(matrix([-1,3,-3,1],(1,4), tc="d"), N) * (1/dt**3)
+    D1, D2, D3, DD2, DD3 = _diff_ops(N)
     
-    DD = lam3 * D3.trans() * D3
+    DD = lam3 * DD3
     # define matices
-    I = spmatrix(1.0, range(N), range(N))
     IM = spmatrix(1.0, range(M), range(M))
-    O = spmatrix([], [], [], (N,N))
     OM = spmatrix([], [], [], (M,M))
-    H = I[idx,:]
-    HH = H.trans()*H
+    H, HH = _observation_ops(idx, N)
 
     Q = 2*sparse([[HH/M+DD/(N-3),H/M,-H/M], # first column of Q
-                [H.trans()/M,IM/M, -H*H.trans()/M], 
-                [-H.trans()/M,-H*H.trans()/M,IM/M]]) 
+                [H.trans()/M,IM/M, -IM/M], # H*H' = IM
+                [-H.trans()/M,-IM/M,IM/M]]) 
     
-    p = 1/M * sparse([-2*H.trans()*matrix(x), -2*matrix(x)+lam1, 2*matrix(x)+lam1])
-    G = sparse([[H*O,H*O],[-IM,OM],[OM,-IM]])
+    p = _get_p_l1(x, H, M, lam1)
+    OMN = spmatrix([], [], [], (M,N))
+    G = sparse([[OMN,OMN],[-IM,OM],[OM,-IM]])
     h = spmatrix([], [], [], (2*M,1))
     
     return Q, p, H, G, h, N, M
@@ -529,15 +591,12 @@ def _get_qp_opt2(x, lam2, lam3):
         raise ZeroDivisionError
         
     # differentiation operator
-    D2 = _blocdiag(matrix([1,-2,1],(1,3), tc="d"), N) * (1/dt**2)
-    D3 = _blocdiag(matrix([-1,3,-3,1],(1,4), tc="d"), N) * (1/dt**3)
+    D1, D2, D3, DD2, DD3 = _diff_ops(N)
     
-    DD2 = lam2 * D2.trans() * D2
-    DD3 = lam3 * D3.trans() * D3
+    DD2 = lam2 * DD2
+    DD3 = lam3 * DD3
     # sol: xhat = (I+delta D'D)^(-1)x
-    I = spmatrix(1.0, range(N), range(N))
-    H = I[idx,:]
-    HH = H.trans() * H
+    H, HH = _observation_ops(idx, N)
 
     Q = 2*(HH/M +DD2/(N-2) + DD3/(N-3))
     p = -2*H.trans() * matrix(x)/M
@@ -562,24 +621,21 @@ def _get_qp_opt2_l1(x, lam2, lam3, lam1):
     if M == 0 or N-3 <= 0:
         raise ZeroDivisionError
     # differentiation operator
-    D2 = _blocdiag(matrix([1,-2,1],(1,3), tc="d"), N) * (1/dt**2)
-    D3 = _blocdiag(matrix([-1,3,-3,1],(1,4), tc="d"), N) * (1/dt**3)
-    DD2 = lam2 * D2.trans() * D2
-    DD3 = lam3 * D3.trans() * D3
+    D1, D2, D3, DD2, DD3 = _diff_ops(N)
+    DD2 = lam2 * DD2
+    DD3 = lam3 * DD3
     # define matices
-    I = spmatrix(1.0, range(N), range(N))
     IM = spmatrix(1.0, range(M), range(M))
-    O = spmatrix([], [], [], (N,N))
     OM = spmatrix([], [], [], (M,M))
-    H = I[idx,:]
-    HH = H.trans()*H
+    H, HH = _observation_ops(idx, N)
 
     Q = 2*sparse([[HH/M+DD2/(N-2)+DD3/(N-3),H/M,-H/M], # first column of Q
-                [H.trans()/M,IM/M, -H*H.trans()/M], 
-                [-H.trans()/M,-H*H.trans()/M,IM/M]]) 
+                [H.trans()/M,IM/M, -IM/M], # H*H' = IM
+                [-H.trans()/M,-IM/M,IM/M]]) 
     
-    p = 1/M * sparse([-2*H.trans()*matrix(x), -2*matrix(x)+lam1, 2*matrix(x)+lam1])
-    G = sparse([[H*O,H*O],[-IM,OM],[OM,-IM]])
+    p = _get_p_l1(x, H, M, lam1)
+    OMN = spmatrix([], [], [], (M,N))
+    G = sparse([[OMN,OMN],[-IM,OM],[OM,-IM]])
     h = spmatrix([], [], [], (2*M,1))
     
     return Q, p, H, G, h, N, M, D2
@@ -605,27 +661,23 @@ def _get_qp_opt2_l1_constr(x, dir, lam2, lam3, lam1):
         raise ZeroDivisionError
         
     # differentiation operator
-    D1 = _blocdiag(matrix([-1,1],(1,2), tc="d"), N) * (1/dt)
-    D2 = _blocdiag(matrix([1,-2,1],(1,3), tc="d"), N) * (1/dt**2)
-    D3 = _blocdiag(matrix([-1,3,-3,1],(1,4), tc="d"), N) * (1/dt**3)
-    DD2 = lam2 * D2.trans() * D2
-    DD3 = lam3 * D3.trans() * D3
+    D1, D2, D3, DD2, DD3 = _diff_ops(N)
+    DD2 = lam2 * DD2
+    DD3 = lam3 * DD3
     
     # define matices
-    I = spmatrix(1.0, range(N), range(N))
     IM = spmatrix(1.0, range(M), range(M))
-    O = spmatrix([], [], [], (N,N))
     OM = spmatrix([], [], [], (M,M))
-    H = I[idx,:]
-    HH = H.trans()*H
+    H, HH = _observation_ops(idx, N)
 
     Q = 2*sparse([[HH/M+DD2/(N-2)+DD3/(N-3),H/M,-H/M], # first column of Q
-                [H.trans()/M,IM/M, -H*H.trans()/M], 
-                [-H.trans()/M,-H*H.trans()/M,IM/M]]) 
+                [H.trans()/M,IM/M, -IM/M], # H*H' = IM
+                [-H.trans()/M,-IM/M,IM/M]]) 
     
-    p = 1/M * sparse([-2*H.trans()*matrix(x), -2*matrix(x)+lam1, 2*matrix(x)+lam1])
+    p = _get_p_l1(x, H, M, lam1)
     B = spmatrix([], [], [], (5*N-11,M))
-    G = sparse([[H*O,H*O,-dir*D1,D2,-D2,D3,-D3],[-IM,OM,B],[OM,-IM, B]])
+    OMN = spmatrix([], [], [], (M,N))
+    G = sparse([[OMN,OMN,_constr_ops(N, dir)],[-IM,OM,B],[OM,-IM, B]])
     h1 = spmatrix([], [], [], (2*M+N-1,1))
     h2 = matrix(1.0, (2*N-4,1)) * 10 # acceleration constraint
     h3 = matrix(1.0, (2*N-6,1)) * 10 # jerk constraint
@@ -639,6 +691,7 @@ def _blocdiag(X, n):
     """
     makes diagonal blocs of X, for indices in [sub1,sub2]
     n indicates the total number of blocks (horizontally)
+    built directly from (values, rows, cols) triplets
     """
     if not isinstance(X, spmatrix):
         X = sparse(X)
@@ -646,28 +699,243 @@ def _blocdiag(X, n):
     if n==b:
         return X
     else:
-        mat = []
-        for i in range(n-b+1):
-            row = spmatrix([],[],[],(1,n))
-            row[i:i+b]=matrix(X,(b,1))
-            mat.append(row)
-        return sparse(mat)
+        vals = np.array(matrix(X)).ravel() # X is one row
+        rows = np.repeat(np.arange(n-b+1), b)
+        cols = rows + np.tile(np.arange(b), n-b+1)
+        return spmatrix(np.tile(vals, n-b+1).tolist(), rows.tolist(), cols.tolist(), (n-b+1, n))
 
 
+@lru_cache(maxsize=256)
+def _diff_ops(N):
+    '''
+    first, second and third order difference operators for N samples, and D2'D2, D3'D3
+    cached by N, the returned matrices must not be modified in place
+    '''
+    D1 = _blocdiag(matrix([-1,1],(1,2), tc="d"), N) * (1/dt)
+    D2 = _blocdiag(matrix([1,-2,1],(1,3), tc="d"), N) * (1/dt**2)
+    D3 = _blocdiag(matrix([-1,3,-3,1],(1,4), tc="d"), N) * (1/dt**3)
+    return D1, D2, D3, D2.trans() * D2, D3.trans() * D3
 
 
+@lru_cache(maxsize=256)
+def _constr_ops(N, dir):
+    '''
+    stacked constraint operators of opt2_l1_constr: [-dir*D1; D2; -D2; D3; -D3], cached by N and dir
+    '''
+    D1, D2, D3, _, _ = _diff_ops(N)
+    return sparse([-dir*D1,D2,-D2,D3,-D3])
 
 
+def _observation_ops(idx, N):
+    '''
+    H selects the observed entries idx out of N, HH = H'H
+    '''
+    M = len(idx)
+    H = spmatrix(1.0, range(M), idx, (M,N))
+    HH = spmatrix(1.0, idx, idx, (N,N))
+    return H, HH
 
-    
-if __name__ == '__main__': 
-    print("not implemented")
 
+def _warm_start(sol, eps=1e-6):
+    '''
+    initvals for solvers.qp from a previous solution of a problem with the same Q, G, h
+    the slacks s and multipliers z have to be strictly positive, entries at 0 are moved to eps
+    '''
+    if sol["s"] is None or sol["z"] is None:
+        return None
+    return {"x": sol["x"], "s": matrix(np.maximum(np.array(sol["s"]), eps)), "z": matrix(np.maximum(np.array(sol["z"]), eps))}
 
-        
-    
-    
+
+def _get_p_l1(x, H, M, lam1):
+    '''
+    linear term of the l1 QPs, x are the observed entries. the only term that depends on lam1
+    '''
+    return 1/M * sparse([-2*H.trans()*matrix(x), -2*matrix(x)+lam1, 2*matrix(x)+lam1])
+
+
+@lru_cache(maxsize=256)
+def _penalty_band(N, lam2, lam3):
+    '''
+    lam2/(N-2) D2'D2 + lam3/(N-3) D3'D3 in the upper banded storage of scipy.linalg.solveh_banded (4 x N)
+    cached by N, lam2, lam3, the returned array is read-only
+    '''
+    _, _, _, DD2, DD3 = _diff_ops(N)
+    band = np.zeros((4, N))
+    for DD, w in ((DD2, lam2/(N-2)), (DD3, lam3/(N-3))):
+        if w == 0:
+            continue
+        I, J, V = np.array(DD.I).ravel(), np.array(DD.J).ravel(), np.array(DD.V).ravel()
+        upper = J >= I
+        np.add.at(band, (3-(J-I)[upper], J[upper]), w*V[upper])
+    band.flags.writeable = False
+    return band
+
+
+def _l1_kktsolver(obs, band):
+    '''
+    KKT solver for solvers.qp on the _get_qp_opt2_l1 problem, variables [x; e+; e-] with e+, e- >= 0
+    the outlier variables and the slacks only couple to their own observation, eliminating them leaves
+    (2P + 2/M H'AH) ux = rhs with A diagonal, which is banded like P. factored once per scaling W
+    '''
+    N = len(obs)
+    M = int(obs.sum())
+    def kktsolver(W):
+        d2 = np.array(W["d"]).ravel()**2 # W'W, for e+ then e-
+        dp, dq = d2[:M], d2[M:]
+        a = 1/(1+2*(dp+dq)/M)
+        ab = 2*band
+        ab[3, obs] += 2/M*a
+        cb = cholesky_banded(ab)
+        def f(x, y, z):
+            # x, z are overwritten with ux, W*uz
+            b = np.array(x).ravel()
+            bz = np.array(z).ravel()
+            beta_p = b[N:N+M]-bz[:M]/dp
+            beta_q = b[N+M:]-bz[M:]/dq
+            g = beta_p*dp-beta_q*dq
+            bx = b[:N].copy()
+            bx[obs] -= 2/M*a*g
+            ux = cho_solve_banded((cb, False), bx)
+            s = (ux[obs]+g)*a # Hux + up - uq
+            up = (beta_p-2*s/M)*dp
+            uq = (beta_q+2*s/M)*dq
+            x[:] = matrix(np.concatenate([ux, up, uq]))
+            z[:] = matrix(np.concatenate([(-up-bz[:M])/np.sqrt(dp), (-uq-bz[M:])/np.sqrt(dq)]))
+        return f
+    return kktsolver
+
+
+def smooth_banded(x, lam2, lam3, lam1=None):
+    '''
+    banded solver for the unconstrained smoothing problems, x: data array with missing data
+    lam1 is None: 1/M||z-Hx||_2^2 + \\lam2/N ||D2x||_2^2 + \\lam3/N ||D3x||_2^2, one banded Cholesky solve
+    otherwise the l1 outlier term is added as in opt2_l1: the same QP is solved by solvers.qp, with the KKT systems
+    of its iterations solved by _l1_kktsolver, so the solution is cvxopt's up to its tolerances
+    returns xhat as a (N,1) cvxopt matrix like the QP solutions
+    '''
+    N = len(x)
+    obs = ~np.isnan(x)
+    z = x[obs]
+    M = len(z)
+    if M == 0 or N <= 3:
+        raise ZeroDivisionError
     
+    band = _penalty_band(N, lam2, lam3)
+    if lam1 is None:
+        ab = band.copy()
+        ab[3, obs] += 1/M
+        rhs = np.zeros(N)
+        rhs[obs] = z/M
+        return matrix(solveh_banded(ab, rhs))
     
+    Q, p, H, G, h, N, M, D2 = _get_qp_opt2_l1(x, lam2, lam3, lam1)
+    sol = solvers.qp(P=Q, q=matrix(p), G=G, h=matrix(h), kktsolver=_l1_kktsolver(obs, band))
+    return sol["x"][:N]
+
+
+
+
+
+
+
     
+if __name__ == '__main__': 
+    # python -m utils.utils_opt [RAW_i ...]
+    # check that resample_uniform reproduces the pandas resampling it replaced on the raw collections, and time both
+    # then check that smooth_banded agrees with the cvxopt QPs on a synthetic 2000-sample trajectory, and time both
+    import sys
+    import time
+    import json
+    import ijson
+    import pandas as pd
+    
+    def resample_pandas(timestamp, data, dt):
+        df = pd.DataFrame(data, columns=data.keys()) 
+        df = df.set_index(pd.to_timedelta(pd.Series(timestamp), unit='s'))
+        df = df.resample('10L').mean().interpolate(method="linear").resample(str(dt)+"S").asfreq()
+        return df.index.values.astype('datetime64[ns]').astype('int64')*1e-9, {key: df[key].values for key in df.columns}
+    
+    if len(sys.argv) > 1:
+        raw_collections = sys.argv[1:]
+    else:
+        with open("parameters.json") as f:
+            raw_collections = [json.load(f)["raw_collection"]]
     
+    fields = ["x_position", "y_position", "length", "width", "height"]
+    for raw_collection in raw_collections:
+        with open(raw_collection+".json", "rb") as f:
+            docs = [doc for doc in ijson.items(f, "item", use_float=True) if len(doc["timestamp"]) > 3]
+        
+        mismatch, max_diff = 0, 0
+        t_pd, t_np = 0, 0
+        for doc in docs:
+            timestamp = np.array(doc["timestamp"], dtype=float)
+            data = {key: np.array(doc[key], dtype=float) for key in fields}
+            t0 = time.time()
+            t1, res1 = resample_pandas(timestamp, data, 0.04)
+            t_pd += time.time()-t0
+            t0 = time.time()
+            t2, res2 = resample_uniform(timestamp, data, dt=0.04)
+            t_np += time.time()-t0
+            
+            if not np.array_equal(t1, t2) or any(not np.array_equal(np.isnan(res1[key]), np.isnan(res2[key])) for key in fields):
+                mismatch += 1
+                continue
+            for key in fields:
+                diff = np.abs(res1[key]-res2[key])
+                if np.any(~np.isnan(diff)):
+                    max_diff = max(max_diff, np.nanmax(diff))
+        
+        print("{}: {} fragments, {} mismatched, max abs diff {:.2e}".format(raw_collection, len(docs), mismatch, max_diff))
+        print("pandas {:.1f} us/fragment, numpy {:.1f} us/fragment, speedup {:.1f}x".format(
+            t_pd/len(docs)*1e6, t_np/len(docs)*1e6, t_pd/max(t_np, 1e-9)))
+    
+    solvers.options["show_progress"] = False
+    rng = np.random.default_rng(0)
+    N = 2000
+    t = np.arange(N)*0.04
+    x = 100 + 90*t + 2*np.sin(t) + rng.normal(0, 1, N)
+    y = 48 + 6*np.tanh(t-40) + rng.normal(0, 0.5, N)
+    outliers = rng.choice(N, 40, replace=False)
+    x[outliers] += rng.normal(0, 20, 40)
+    y[outliers] += rng.normal(0, 5, 40)
+    x[rng.random(N) < 0.1] = np.nan
+    y[np.isnan(x)] = np.nan
+    
+    def huber_objective(z, zhat, lam2, lam3, lam1):
+        r = np.abs(z-zhat)[~np.isnan(z)]
+        loss = r**2 if lam1 is None else np.where(r <= lam1/2, r**2, lam1*r-lam1**2/4)
+        return np.mean(loss) + lam2/(N-2)*np.sum((np.diff(zhat, 2)/dt**2)**2) + lam3/(N-3)*np.sum((np.diff(zhat, 3)/dt**3)**2)
+    
+    for z, lam2, lam3, lam1 in [(x, 0, 1e-7, None), (x, 1e-3, 1e-7, None), (y, 0, 1e-7, None),
+                                (x, 0, 1e-7, 1e-1), (y, 0, 1e-7, 1e-1), (y, 1e-2, 1e-7, 1), (x, 0, 1e-7, 1e-3), (y, 0, 1e-7, 0)]:
+        t0 = time.time()
+        if lam1 is None:
+            Q, p, H, N, M = _get_qp_opt2(z, lam2, lam3)
+            sol = solvers.qp(P=Q, q=p)
+        else:
+            Q, p, H, G, h, N, M, D2 = _get_qp_opt2_l1(z, lam2, lam3, lam1)
+            sol = solvers.qp(P=Q, q=matrix(p), G=G, h=matrix(h))
+        t_qp = time.time()-t0
+        t0 = time.time()
+        zhat = np.reshape(smooth_banded(z, lam2, lam3, lam1), -1)
+        t_band = time.time()-t0
+        zhat_qp = np.reshape(sol["x"][:N], -1)
+        f_qp, f_band = huber_objective(z, zhat_qp, lam2, lam3, lam1), huber_objective(z, zhat, lam2, lam3, lam1)
+        print("N={} lam2={} lam3={} lam1={}: max abs diff {:.2e}, objective cvxopt {:.6e} banded {:.6e}".format(
+            N, lam2, lam3, lam1, np.max(np.abs(zhat-zhat_qp)), f_qp, f_band))
+        assert np.max(np.abs(zhat-zhat_qp)) < 1e-4, "smooth_banded differs from cvxopt by more than 1e-4"
+        assert f_band <= f_qp*(1+1e-6)+1e-12, "smooth_banded objective is higher than cvxopt"
+        print("    cvxopt {:.1f} ms, banded {:.2f} ms".format(t_qp*1e3, t_band*1e3))
+    
+    car = {"timestamp": t, "x_position": x, "y_position": y, "direction": 1}
+    for solver_y in ["cvxopt", "banded"]:
+        t0 = time.time()
+        opt2_l1_constr(dict(car), lam2_x=0, lam2_y=0, lam3_x=1e-7, lam3_y=1e-7, lam1_x=1e-3, lam1_y=0, lam1_rtol=1e-2, solver_y=solver_y)
+        print("opt2_l1_constr N={} solver_y={}: {:.1f} ms".format(N, solver_y, (time.time()-t0)*1e3))
+    
+    car = {"timestamp": t, "x_position": x, "y_position": y}
+    for solver in ["cvxopt", "banded"]:
+        t0 = time.time()
+        opt2(dict(car), lam2_x=0, lam2_y=0, lam3_x=1e-7, lam3_y=1e-7, solver_x=solver, solver_y=solver)
+        print("opt2 N={} solver={}: {:.1f} ms".format(N, solver, (time.time()-t0)*1e3))
@@ -27,6 +27,18 @@ def bhattacharyya_distance(mu1, mu2, cov1, cov2):
         return dist
     
 
+def bhattacharyya_distance_diag(mu1, mu2, var1, var2, axis=None):
+    '''
+    same as bhattacharyya_distance for diagonal covariances, given by their variance vectors var1 and var2
+    O(n) and the log-determinants are sums of logs, so they do not over/underflow like the determinants
+    axis: sum over all dimensions (None), or along axis to get one distance per row
+    '''
+    mu = mu1-mu2
+    var = (var1+var2)/2
+    dist = 0.125 * np.sum(mu*mu/var, axis=axis) + 0.5 * np.sum(np.log(var) - 0.5*(np.log(var1) + np.log(var2)), axis=axis)
+    return np.where(dist < -999, 999, dist) if axis is not None else (999 if dist < -999 else dist)
+    
+
 def bhattacharyya_coeff(bhatt_dist):
     return np.exp(-bhatt_dist)
 
@@ -42,95 +54,107 @@ def weighted_least_squares(t,x,y,weights=None):
     fity = [resy.params[1],resy.params[0]]
     return fitx, fity
 
+def weighted_fit(t, x, y, weights):
+    '''
+    closed-form weighted least squares fit of x and y against t, same fit as weighted_least_squares
+    return: tbar, xbar, ybar (weighted means), slope_x, slope_y
+    i.e., x(t) = xbar + slope_x * (t-tbar), same for y
+    '''
+    wsum = np.sum(weights)
+    tbar = np.dot(weights, t)/wsum
+    xbar = np.dot(weights, x)/wsum
+    ybar = np.dot(weights, y)/wsum
+    tc = t-tbar
+    stt = np.dot(weights, tc*tc)
+    if stt == 0:
+        return tbar, xbar, ybar, 0.0, 0.0
+    return tbar, xbar, ybar, np.dot(weights, tc*x)/stt, np.dot(weights, tc*y)/stt
+
+
+def kinematic_fits(track):
+    '''
+    head and tail fits of a track used by stitch_cost, computed once and cached in track["head_fit"] and track["tail_fit"]
+    tail: fit on the last ~1 sec of data, more weights towards the end
+    head: fit on the first ~1 sec of data, more weights towards the front
+    each fit is (t_ref, tbar, xbar, ybar, slope_x, slope_y, var_y), with tbar relative to t_ref (the last or first timestamp)
+    to avoid large numbers, and var_y the variance of y in the same ~1 sec
+    '''
+    if "tail_fit" in track:
+        return track["head_fit"], track["tail_fit"]
+    
+    t = np.asarray(track["timestamp"], dtype=float)
+    x = np.asarray(track["x_position"], dtype=float)
+    y = np.asarray(track["y_position"], dtype=float)
+    n = min(len(t), int(1/dt))
+    
+    tail = weighted_fit(t[-n:]-t[-1], x[-n:], y[-n:], np.linspace(1e-6, 1, n))
+    head = weighted_fit(t[:n]-t[0], x[:n], y[:n], np.linspace(1, 1e-6, n))
+    track["tail_fit"] = (t[-1],) + tail + (np.var(y[-n:]),)
+    track["head_fit"] = (t[0],) + head + (np.var(y[:n]),)
+    return track["head_fit"], track["tail_fit"]
+
+
+def _tail_member(track):
+    return track["tile_members"][-1] if "tile_members" in track else track
+
+
+def _head_member(track):
+    return track["tile_members"][0] if "tile_members" in track else track
+
+
 def stitch_cost(track1, track2, TIME_WIN, param):
     '''
     use bhattacharyya_distance
     track t,x,y must not have nans!
+    the weighted least squares fits are taken from kinematic_fits (cached on the tracks)
+    a stitched trajectory from a tile (with "tile_members") is scored by its last / first original fragment, as the
+    single stitcher would score them
     '''
     # print("compare ",track1["_id"], track2["_id"])
+    track1 = _tail_member(track1)
+    track2 = _head_member(track2)
     t1 = track1["timestamp"] #[filter1]
     t2 = track2["timestamp"] #[filter2]
     
-    # offset timestamps to avoid large numbers in weighted least squares fit
-    toffset = min(t1[0], t2[0])
-    t1 = t1-toffset
-    t2 = t2-toffset
-    
     gap = t2[0] - t1[-1] 
     if gap < 0 or gap > TIME_WIN:
         return 1e6
     
-    x1 = track1["x_position"]#[filter1]
-    x2 = track2["x_position"]#[filter2]
-    
-    y1 = track1["y_position"]#[filter1]
-    y2 = track2["y_position"]#[filter2]
-
     n1 = min(len(t1), int(1/dt)) # for track1
     n2 = min(len(t2), int(1/dt)) # for track2
         
     if len(t1) >= len(t2):
-        anchor = 1 # project forward in time
         direction = track1["direction"]
-        # find the new fit for anchor1 based on the last ~1 sec of data
-        t1 = t1[-n1:]
-        x1 = x1[-n1:]
-        y1 = y1[-n1:] # TODO: could run into the danger that the ends of a track has bad speed estimate
-        # fitx, fity = calc_fit_select_ransac(t1,x1,y1,residual_threshold_x, residual_threshold_y)
-        # fitx, fity = calc_fit_select(t1,x1,y1)
-        weights = np.linspace(1e-6, 1, len(t1)) # put more weights towards end
-        fitx, fity = weighted_least_squares(t1,x1,y1,weights)
+        # fit for anchor1 based on the last ~1 sec of data
+        t_ref, tbar, xbar, ybar, slope_x, slope_y, _ = kinematic_fits(track1)[1]
+        vary_meas = kinematic_fits(track2)[0][6]
         
         # get the first chunk of track2
-        meast = t2[:n2]
-        measx = x2[:n2]
-        measy = y2[:n2]
-        pt = t1[-1] # cone starts at the end of t1
-        y0 = y1[-1]
-        dir = 1 # cone should open to the +1 direction in time (predict track1 to future)
-        
+        meast = np.asarray(t2[:n2])
+        measx = track2["x_position"][:n2]
+        measy = track2["y_position"][:n2]
+        trel = meast - t_ref
+        tdiff = trel # cone starts at the end of t1, opens to the +1 direction in time (predict track1 to future)
         
     else:
-        anchor = 2
         direction = track2["direction"]
-        # find the new fit for anchor2 based on the first ~1 sec of track2
-        t2 = t2[:n2]
-        x2 = x2[:n2]
-        y2 = y2[:n2]
-        
-        # fitx, fity = calc_fit_select_ransac(t2,x2,y2,residual_threshold_x, residual_threshold_y)
-        # fitx, fity = calc_fit_select(t2,x2,y2)
-        weights = np.linspace(1, 1e-6, len(t2)) # put more weights towards front
-        fitx, fity = weighted_least_squares(t2,x2,y2,weights)
+        # fit for anchor2 based on the first ~1 sec of track2
+        t_ref, tbar, xbar, ybar, slope_x, slope_y, _ = kinematic_fits(track2)[0]
+        vary_meas = kinematic_fits(track1)[1][6]
         
-        pt = t2[0]
-        y0 = y2[0]
         # get the last chunk of tarck1
-        meast = t1[-n1:]
-        measx = x1[-n1:]
-        measy = y1[-n1:]
-        dir = -1 # use the fit of track2 to "predict" back in time
+        meast = np.asarray(t1[-n1:])
+        measx = track1["x_position"][-n1:]
+        measy = track1["y_position"][-n1:]
+        trel = meast - t_ref
+        tdiff = -trel # use the fit of track2 to "predict" back in time
   
-    # find where to start the cone
-    try:
-        tdiff = (meast - pt) * dir # tdiff should be positive
-    except TypeError:
-        meast = np.array(meast)
-        tdiff = (meast - pt) * dir 
-        
     # bound x-velocity to non-negative for each direction
-    slope, intercept = fitx
-    if slope * direction < 0:
-        slope = 0
-        if anchor==1:
-            intercept = sum(weights * x1)/sum(weights)
-        else:
-            intercept = sum(weights * x2)/sum(weights)
-    targetx = slope * meast + intercept
-    slope, intercept = fity
-    targety = slope * meast + intercept
-    # targety = 0 * meast + y0
-    # print(anchor, fitx, fity)
+    if slope_x * direction < 0:
+        targetx = np.full(len(meast), xbar) # weighted mean of x
+    else:
+        targetx = slope_x * (trel - tbar) + xbar
+    targety = slope_y * (trel - tbar) + ybar
     cx, mx, cy, my = param["cx"], param["mx"], param["cy"], param["my"]
 
     # old
@@ -143,24 +167,23 @@ def stitch_cost(track1, track2, TIME_WIN, param):
     # sigmay = cy + my*tdiff
     
     # new, can avoide bhatt_distance divided by zero
-    sigmax = cx + mx * tdiff * abs(fitx[0])
-    sigmay = cy + my * tdiff * abs(fity[0])  
+    sigmax = cx + mx * tdiff * abs(slope_x)
+    sigmay = cy + my * tdiff * abs(slope_y)  
 
     varx = sigmax**2
     vary_pred = sigmay**2
-    vary_meas = np.var(measy)
     vary_meas = max(vary_meas, cy**2) # lower bound 
 
     # vectorize!
     n = len(meast)
     mu1 = np.hstack([targetx, targety]) # 1x 2n
     mu2 = np.hstack([measx, measy]) # 1 x 2n
-    cov1 = np.diag(np.hstack([varx, vary_pred])) # 2n x 2n
-    cov2 = np.diag(np.hstack([np.ones(n)*varx[0], np.ones(n)*vary_meas])) 
+    var1 = np.hstack([varx, vary_pred]) # diagonal of the 2n x 2n covariance
+    var2 = np.hstack([np.ones(n)*varx[0], np.ones(n)*vary_meas]) 
     
 
     try:
-        bd = bhattacharyya_distance(mu1, mu2, cov1, cov2)
+        bd = bhattacharyya_distance_diag(mu1, mu2, var1, var2)
         nll = bd/n # mean
     except Exception as e:
         print("{} in stitch_cost for {} and {}, assigned cost=10e6".format(str(e), track1["_id"], track2["_id"]))
@@ -181,6 +204,81 @@ def stitch_cost(track1, track2, TIME_WIN, param):
 
 
 
+def stitch_cost_batch(tracks, track2, TIME_WIN, param):
+    '''
+    stitch_cost(track1, track2, TIME_WIN, param) for every track1 in tracks, in one vectorized pass
+    the measurement chunks (up to ~1 sec each) are padded to the same length, padded entries have mu1=mu2 and var1=var2
+    so that they do not add to the bhattacharyya distance
+    return: array of costs, 1e6 where stitch_cost would return 1e6 (gap out of range or numerical error)
+    '''
+    N = int(1/dt)
+    K = len(tracks)
+    cost = np.full(K, 1e6)
+    if K == 0:
+        return cost
+    track2 = _head_member(track2)
+    t2 = track2["timestamp"]
+    head2, tail2 = kinematic_fits(track2)
+    n2 = min(len(t2), N)
+    
+    fits = np.zeros((K, 7)) # anchor fit, see kinematic_fits
+    direction = np.zeros(K)
+    sign = np.zeros(K) # +1: predict track1 to future, -1: predict track2 back in time
+    vary_meas = np.zeros(K)
+    gap = np.zeros(K)
+    meast, measx, measy = np.zeros((K, N)), np.zeros((K, N)), np.zeros((K, N))
+    mask = np.zeros((K, N), dtype=bool)
+    valid = np.zeros(K, dtype=bool)
+    
+    for k, track1 in enumerate(tracks):
+        track1 = _tail_member(track1)
+        t1 = track1["timestamp"]
+        gap[k] = t2[0] - t1[-1]
+        if gap[k] < 0 or gap[k] > TIME_WIN:
+            continue
+        valid[k] = True
+        head1, tail1 = kinematic_fits(track1)
+        if len(t1) >= len(t2):
+            fits[k], direction[k], sign[k], vary_meas[k] = tail1, track1["direction"], 1, head2[6]
+            n = n2
+            meast[k, :n], measx[k, :n], measy[k, :n] = t2[:n], track2["x_position"][:n], track2["y_position"][:n]
+        else:
+            fits[k], direction[k], sign[k], vary_meas[k] = head2, track2["direction"], -1, tail1[6]
+            n = min(len(t1), N)
+            meast[k, :n], measx[k, :n], measy[k, :n] = t1[-n:], track1["x_position"][-n:], track1["y_position"][-n:]
+        mask[k, :n] = True
+    
+    if not valid.any():
+        return cost
+    fits, direction, sign, vary_meas, gap = fits[valid], direction[valid], sign[valid], vary_meas[valid], gap[valid]
+    meast, measx, measy, mask = meast[valid], measx[valid], measy[valid], mask[valid]
+    t_ref, tbar, xbar, ybar, slope_x, slope_y, _ = [col[:, None] for col in fits.T]
+    cx, mx, cy, my = param["cx"], param["mx"], param["cy"], param["my"]
+    
+    with np.errstate(all="ignore"):
+        trel = meast - t_ref
+        tdiff = sign[:, None] * trel
+        # bound x-velocity to non-negative for each direction
+        targetx = np.where(slope_x * direction[:, None] < 0, xbar, slope_x * (trel - tbar) + xbar)
+        targety = slope_y * (trel - tbar) + ybar
+        varx = (cx + mx * tdiff * np.abs(slope_x))**2
+        vary_pred = (cy + my * tdiff * np.abs(slope_y))**2
+        vary_meas = np.maximum(vary_meas, cy**2)[:, None]
+        
+        mask2 = np.hstack([mask, mask])
+        mu1 = np.where(mask2, np.hstack([targetx, targety]), 0)
+        mu2 = np.where(mask2, np.hstack([measx, measy]), 0)
+        var1 = np.where(mask2, np.hstack([varx, vary_pred]), 1)
+        var2 = np.where(mask2, np.hstack([np.broadcast_to(varx[:, :1], varx.shape), np.broadcast_to(vary_meas, varx.shape)]), 1)
+        
+        bd = bhattacharyya_distance_diag(mu1, mu2, var1, var2, axis=1)
+        tot_cost = bd / mask.sum(axis=1) + 0.1 * gap
+    
+    cost[valid] = np.where(np.isfinite(tot_cost), tot_cost, 1e6)
+    return cost
+
+
+
 def stitch_cost_simple_distance(track1, track2, TIME_WIN, param):
     """
     A simple distance metric ||p_i(t_e^i)-p_j(t_s^j)||_2^2